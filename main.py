@@ -1,24 +1,108 @@
 # app.py
 
 import streamlit as st
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime, func
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime, func, select, \
+    event, inspect, text, update, delete, exists, Index, Date, case, Boolean, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship, joinedload
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from inspect import isgeneratorfunction, signature
+from dataclasses import dataclass
+from typing import Iterator, NamedTuple
 import pandas as pd
 import matplotlib.pyplot as plt
+import openpyxl
+import argparse
+import bisect
+import cProfile
+import pstats
+import threading
+import queue
+import functools
+import hashlib
+import math
+import calendar
+import sqlite3
+import shutil
+import tempfile
+import gzip
+import glob
+import tracemalloc
 import random
+import time
+import sys
 import os
 import io
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet es opcional
+    pa = None
+    pq = None
+
 # Configuración de la Base de Datos
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATABASE_URL = f"sqlite:///{os.path.join(BASE_DIR, 'gasto_magico.db')}"
+DATABASE_PATH = os.path.join(BASE_DIR, 'gasto_magico.db')
+DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+RESPALDOS_DIR = os.path.join(BASE_DIR, 'respaldos')
+MONEDA_PREDETERMINADA = 'USD'
+ESPERA_BLOQUEO_MS = 5000
 
-engine = create_engine(DATABASE_URL, echo=False)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+def hash_gasto(fecha, monto, descripcion, categoria_id, metodo_pago_id, moneda=MONEDA_PREDETERMINADA) -> str:
+    """Hash del contenido normalizado de un gasto, usado para detectar duplicados."""
+    if isinstance(fecha, date) and not isinstance(fecha, datetime):
+        fecha = datetime.combine(fecha, datetime.min.time())
+    contenido = "|".join([
+        str(fecha or "")[:19],
+        f"{round(float(monto), 2):.2f}",
+        " ".join(str(descripcion).split()).casefold(),
+        str(categoria_id or ""),
+        str(metodo_pago_id or ""),
+        str(moneda or MONEDA_PREDETERMINADA).upper(),
+    ])
+    return hashlib.sha1(contenido.encode("utf-8")).hexdigest()
+
+
+def crear_motor(url: str = DATABASE_URL):
+    """Motor SQLite en modo WAL, con espera ante bloqueos y las funciones SQL de la aplicación."""
+    motor = create_engine(url, echo=False)
+
+    @event.listens_for(motor, "connect")
+    def configurar_conexion(conexion, _):
+        # Permite recalcular los hashes en SQL sin cargar las filas en Python
+        conexion.create_function("hash_gasto", -1, hash_gasto, deterministic=True)
+        # SQLAlchemy emite BEGIN por su cuenta (ver abajo) para que los SAVEPOINT funcionen con pysqlite
+        conexion.isolation_level = None
+        # En WAL los lectores no bloquean al escritor; busy_timeout espera en lugar de fallar con "database is locked"
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute(f"PRAGMA busy_timeout={ESPERA_BLOQUEO_MS}")
+        # Solo surte efecto en bases nuevas; las existentes se convierten en el primer mantenimiento
+        conexion.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+    @event.listens_for(motor, "begin")
+    def iniciar_transaccion(conexion):
+        # Las transacciones de escritura toman el bloqueo al empezar: en WAL, una transacción diferida que leyó
+        # antes de que otro escritor confirmara falla al escribir sin esperar el busy_timeout
+        if conexion.get_execution_options().get('escritura'):
+            conexion.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            conexion.exec_driver_sql("BEGIN")
+
+    return motor
+
+
+engine = crear_motor()
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
 # Definición de Modelos
 class Categoria(Base):
     __tablename__ = 'categorias'
@@ -28,7 +112,7 @@ class Categoria(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    gastos = relationship("Gasto", back_populates="categoria")
+    gastos = relationship("Gasto", back_populates="categoria", passive_deletes=True)
 
     def __repr__(self):
         return f"<Categoria(id={self.id}, nombre='{self.nombre}')>"
@@ -42,7 +126,7 @@ class MetodoPago(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    gastos = relationship("Gasto", back_populates="metodo_pago")
+    gastos = relationship("Gasto", back_populates="metodo_pago", passive_deletes=True)
 
     def __repr__(self):
         return f"<MetodoPago(id={self.id}, nombre='{self.nombre}')>"
@@ -50,6 +134,13 @@ class MetodoPago(Base):
 
 class Gasto(Base):
     __tablename__ = 'gastos'
+    __table_args__ = (
+        Index('ix_gastos_fecha', 'fecha'),
+        Index('ix_gastos_categoria_fecha', 'categoria_id', 'fecha'),
+        Index('ix_gastos_metodo_pago_fecha', 'metodo_pago_id', 'fecha'),
+        Index('ix_gastos_monto', 'monto'),
+        Index('ix_gastos_recurrente_periodo', 'recurrente_id', 'periodo', unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     fecha = Column(DateTime, default=datetime.utcnow)
@@ -57,6 +148,12 @@ class Gasto(Base):
     descripcion = Column(String, nullable=False)
     categoria_id = Column(Integer, ForeignKey('categorias.id'))
     metodo_pago_id = Column(Integer, ForeignKey('metodos_pago.id'))
+    moneda = Column(String(3), nullable=False, default=MONEDA_PREDETERMINADA,
+                    server_default=MONEDA_PREDETERMINADA)
+    hash_contenido = Column(String, unique=True, index=True)
+    # Gastos generados por una regla recurrente: una sola fila por regla y periodo
+    recurrente_id = Column(Integer, ForeignKey('gastos_recurrentes.id'))
+    periodo = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -67,6 +164,19 @@ class Gasto(Base):
         return f"<Gasto(id={self.id}, monto={self.monto}, descripcion='{self.descripcion}')>"
 
 
+@event.listens_for(Gasto, "before_insert")
+@event.listens_for(Gasto, "before_update")
+def actualizar_hash_gasto(mapper, conexion, gasto):
+    if gasto.fecha is None and gasto.id is None:
+        gasto.fecha = datetime.utcnow()
+    if gasto.moneda is None:
+        gasto.moneda = MONEDA_PREDETERMINADA
+    # Solo los gastos importados llevan hash (los manuales pueden repetirse); al editarlos se mantiene al día
+    if gasto.hash_contenido is not None:
+        gasto.hash_contenido = hash_gasto(gasto.fecha, gasto.monto, gasto.descripcion, gasto.categoria_id,
+                                          gasto.metodo_pago_id, gasto.moneda)
+
+
 class FraseMotivacional(Base):
     __tablename__ = 'frases_motivacionales'
 
@@ -84,6 +194,8 @@ class Configuracion(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     limite_gasto = Column(Float, nullable=False, default=0.0)
+    moneda_base = Column(String(3), nullable=False, default=MONEDA_PREDETERMINADA,
+                         server_default=MONEDA_PREDETERMINADA)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -91,9 +203,324 @@ class Configuracion(Base):
         return f"<Configuracion(id={self.id}, limite_gasto={self.limite_gasto})>"
 
 
+class GastoRecurrente(Base):
+    __tablename__ = 'gastos_recurrentes'
+
+    id = Column(Integer, primary_key=True, index=True)
+    descripcion = Column(String, nullable=False)
+    monto = Column(Float, nullable=False)
+    moneda = Column(String(3), nullable=False, default=MONEDA_PREDETERMINADA)
+    categoria_id = Column(Integer, ForeignKey('categorias.id'))
+    metodo_pago_id = Column(Integer, ForeignKey('metodos_pago.id'))
+    # 'mensual': ``dia`` es el día del mes (se ajusta al último día en meses cortos)
+    # 'semanal': ``dia`` es el día de la semana, 0 = lunes
+    frecuencia = Column(String, nullable=False)
+    dia = Column(Integer, nullable=False)
+    fecha_inicio = Column(Date, nullable=False)
+    fecha_fin = Column(Date)
+    ultima_fecha = Column(Date)
+    activo = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<GastoRecurrente(id={self.id}, descripcion='{self.descripcion}', frecuencia='{self.frecuencia}')>"
+
+
+class TipoCambio(Base):
+    """Valor de una unidad de ``moneda`` expresado en ``moneda_base``, vigente desde ``fecha``.
+
+    ``moneda_base`` es la moneda base configurada al cargar la tasa: al cambiar la moneda base, las tasas cotizadas
+    en la anterior dejan de aplicarse en lugar de leerse como si estuvieran en la nueva.
+    """
+    __tablename__ = 'tipos_cambio'
+    __table_args__ = (
+        Index('ix_tipos_cambio_moneda_base_fecha', 'moneda', 'moneda_base', 'fecha', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    moneda = Column(String(3), nullable=False)
+    moneda_base = Column(String(3), nullable=False, server_default=MONEDA_PREDETERMINADA)
+    fecha = Column(Date, nullable=False)
+    tasa = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return (f"<TipoCambio(moneda='{self.moneda}', moneda_base='{self.moneda_base}', fecha={self.fecha}, "
+                f"tasa={self.tasa})>")
+
+
+class EstadisticaGasto(Base):
+    """Estadísticas corridas (Welford) del monto en moneda base, por categoría o por método de pago."""
+    __tablename__ = 'estadisticas_gastos'
+
+    dimension = Column(String, primary_key=True)
+    clave_id = Column(Integer, primary_key=True)
+    n = Column(Integer, nullable=False, default=0)
+    media = Column(Float, nullable=False, default=0.0)
+    m2 = Column(Float, nullable=False, default=0.0)
+    minimo = Column(Float)
+    maximo = Column(Float)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @property
+    def desviacion(self) -> float:
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    def __repr__(self):
+        return f"<EstadisticaGasto(dimension='{self.dimension}', clave_id={self.clave_id}, n={self.n})>"
+
+
+class VersionDatos(Base):
+    """Contador global que aumenta con cada escritura; las lecturas cacheadas se indexan por su valor."""
+    __tablename__ = 'version_datos'
+
+    id = Column(Integer, primary_key=True)
+    valor = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<VersionDatos(valor={self.valor})>"
+
+
+class MantenimientoBaseDatos(Base):
+    """Historial de ejecuciones del mantenimiento de la base de datos."""
+    __tablename__ = 'mantenimientos'
+
+    id = Column(Integer, primary_key=True)
+    ejecutado_en = Column(DateTime, default=datetime.utcnow, nullable=False)
+    segundos = Column(Float, nullable=False)
+    bytes_antes = Column(Integer, nullable=False)
+    bytes_despues = Column(Integer, nullable=False)
+    proporcion_libre_antes = Column(Float, nullable=False)
+    proporcion_libre_despues = Column(Float, nullable=False)
+    operaciones = Column(String, nullable=False)
+
+    def __repr__(self):
+        return f"<MantenimientoBaseDatos(ejecutado_en={self.ejecutado_en}, operaciones='{self.operaciones}')>"
+
+
+class CambioGasto(Base):
+    """Registro de inserciones, actualizaciones y eliminaciones de gastos, escrito por triggers."""
+    __tablename__ = 'cambios_gastos'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    # AUTOINCREMENT garantiza que la secuencia nunca reutiliza valores, aunque se purgue el registro
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    gasto_id = Column(Integer, nullable=False)
+    operacion = Column(String(1), nullable=False)
+    registrado_en = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<CambioGasto(seq={self.seq}, gasto_id={self.gasto_id}, operacion='{self.operacion}')>"
+
+
+TRIGGERS_CAMBIOS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS tr_gastos_{nombre} AFTER {evento} ON gastos
+    BEGIN
+        INSERT INTO cambios_gastos (gasto_id, operacion, registrado_en)
+        VALUES ({fila}.id, '{operacion}', datetime('now'));
+    END
+    """
+    for nombre, evento, fila, operacion in (
+        ('insert', 'INSERT', 'NEW', 'I'),
+        ('update', 'UPDATE', 'NEW', 'U'),
+        ('delete', 'DELETE', 'OLD', 'D'),
+    )
+]
+
+
+# Versión de los Datos
+def registrar_escritura(db, desde: int = 0) -> None:
+    """Aumenta la versión de los datos dentro de la transacción en curso.
+
+    Se invoca antes de cada commit de los casos de uso; ``desde`` garantiza que el nuevo valor supere
+    uno conocido (por ejemplo, al restaurar un respaldo con una versión más antigua).
+    """
+    tabla = VersionDatos.__table__
+    sentencia = sqlite_insert(tabla).values(id=1, valor=desde + 1)
+    db.execute(sentencia.on_conflict_do_update(
+        index_elements=[tabla.c.id],
+        set_={'valor': func.max(tabla.c.valor, desde) + 1}
+    ))
+
+
+def version_datos() -> int:
+    db = SessionLocal()
+    try:
+        return db.execute(select(VersionDatos.valor).where(VersionDatos.id == 1)).scalar() or 0
+    finally:
+        db.close()
+
+
+def version_vigente() -> int:
+    """Versión de los datos para las lecturas del rerun en curso.
+
+    Dentro de Streamlit se consulta una vez por rerun y se guarda en la sesión hasta que ``olvidar_version`` la
+    descarta (al empezar cada rerun y después de cada escritura); fuera de Streamlit se consulta en cada llamada.
+    """
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return version_datos()
+    if 'version_datos' not in st.session_state:
+        st.session_state['version_datos'] = version_datos()
+    return st.session_state['version_datos']
+
+
+def olvidar_version() -> None:
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        st.session_state.pop('version_datos', None)
+
+
+# Modelos de Lectura
+# Las consultas de solo lectura devuelven tuplas livianas en lugar de objetos ORM desacoplados de su sesión
+class GastoFila(NamedTuple):
+    id: int
+    fecha: datetime
+    monto: float
+    descripcion: str
+    categoria_id: int
+    categoria: str
+    metodo_pago_id: int
+    metodo_pago: str
+    moneda: str
+    monto_base: float
+
+
+class CategoriaFila(NamedTuple):
+    id: int
+    nombre: str
+
+
+class MetodoPagoFila(NamedTuple):
+    id: int
+    nombre: str
+
+
+class FraseFila(NamedTuple):
+    id: int
+    texto: str
+
+
+class PaginaGastos(NamedTuple):
+    filas: list
+    total: int
+    pagina: int
+    tamano_pagina: int
+
+    @property
+    def paginas(self) -> int:
+        return max(1, -(-self.total // self.tamano_pagina)) if self.tamano_pagina else 1
+
+
+def consulta_gasto_filas():
+    # ``monto_base`` convierte a la moneda base configurada (NULL si falta el tipo de cambio)
+    moneda_base = func.coalesce(select(Configuracion.moneda_base).limit(1).scalar_subquery(), MONEDA_PREDETERMINADA)
+    return select(
+        Gasto.id,
+        Gasto.fecha,
+        Gasto.monto,
+        Gasto.descripcion,
+        Gasto.categoria_id,
+        Categoria.nombre,
+        Gasto.metodo_pago_id,
+        MetodoPago.nombre,
+        Gasto.moneda,
+        func.round(monto_en_base(moneda_base), 2)
+    ).outerjoin(Categoria, Gasto.categoria_id == Categoria.id) \
+        .outerjoin(MetodoPago, Gasto.metodo_pago_id == MetodoPago.id)
+
+
+# Migraciones del Esquema
+def _migracion_hash_contenido(conexion):
+    # Los gastos existentes no llevan hash: no se sabe cuáles se importaron, y los cargados a mano pueden repetirse
+    conexion.execute(text("ALTER TABLE gastos ADD COLUMN hash_contenido VARCHAR"))
+
+
+def _migracion_moneda(conexion):
+    conexion.execute(text(f"ALTER TABLE gastos ADD COLUMN moneda VARCHAR(3) NOT NULL DEFAULT '{MONEDA_PREDETERMINADA}'"))
+    conexion.execute(text(
+        f"ALTER TABLE configuraciones ADD COLUMN moneda_base VARCHAR(3) NOT NULL DEFAULT '{MONEDA_PREDETERMINADA}'"
+    ))
+    # La moneda forma parte del hash de contenido
+    conexion.execute(text("""
+        UPDATE gastos SET hash_contenido = hash_gasto(fecha, monto, descripcion, categoria_id, metodo_pago_id, moneda)
+        WHERE hash_contenido IS NOT NULL
+    """))
+
+
+def monto_en_base(moneda_base: str):
+    """Expresión SQL con el monto del gasto convertido a ``moneda_base``.
+
+    Usa el último tipo de cambio vigente en la fecha del gasto (o el primero conocido si el gasto es anterior),
+    resuelto con el índice (moneda, moneda_base, fecha); los gastos en monedas sin tipo de cambio a ``moneda_base``
+    quedan en NULL.
+    """
+    vigente = select(TipoCambio.tasa).where(
+        TipoCambio.moneda == Gasto.moneda,
+        TipoCambio.moneda_base == moneda_base,
+        TipoCambio.fecha <= func.date(Gasto.fecha)
+    ).order_by(TipoCambio.fecha.desc()).limit(1).scalar_subquery()
+    primera = select(TipoCambio.tasa).where(
+        TipoCambio.moneda == Gasto.moneda,
+        TipoCambio.moneda_base == moneda_base
+    ).order_by(TipoCambio.fecha.asc()).limit(1).scalar_subquery()
+    return case(
+        (Gasto.moneda == moneda_base, Gasto.monto),
+        else_=Gasto.monto * func.coalesce(vigente, primera)
+    )
+
+
+def _migracion_recurrentes(conexion):
+    conexion.execute(text("ALTER TABLE gastos ADD COLUMN recurrente_id INTEGER REFERENCES gastos_recurrentes (id)"))
+    conexion.execute(text("ALTER TABLE gastos ADD COLUMN periodo VARCHAR"))
+
+
+def _migracion_moneda_cotizacion(conexion):
+    # La tabla de tipos de cambio puede haberse creado ya con la columna si la base es anterior a ella
+    columnas = {columna['name'] for columna in inspect(conexion).get_columns(TipoCambio.__tablename__)}
+    if 'moneda_base' not in columnas:
+        conexion.execute(text(
+            f"ALTER TABLE tipos_cambio ADD COLUMN moneda_base VARCHAR(3) NOT NULL DEFAULT '{MONEDA_PREDETERMINADA}'"
+        ))
+        # Las tasas cargadas hasta ahora están cotizadas en la moneda base vigente
+        base = conexion.execute(text("SELECT moneda_base FROM configuraciones LIMIT 1")).scalar()
+        conexion.execute(text("UPDATE tipos_cambio SET moneda_base = :base"),
+                         {'base': base or MONEDA_PREDETERMINADA})
+    # El índice único pasa a incluir la moneda de cotización
+    conexion.execute(text("DROP INDEX IF EXISTS ix_tipos_cambio_moneda_fecha"))
+
+
+# Cada migración se aplica una sola vez; PRAGMA user_version guarda cuántas se aplicaron
+MIGRACIONES = [
+    _migracion_hash_contenido,
+    _migracion_moneda,
+    _migracion_recurrentes,
+    _migracion_moneda_cotizacion,
+]
+
+
+def migrar_esquema():
+    with engine.begin() as conexion:
+        existia = inspect(conexion).has_table(Gasto.__tablename__)
+        Base.metadata.create_all(bind=conexion)
+        version = conexion.execute(text("PRAGMA user_version")).scalar()
+        if existia:
+            for migracion in MIGRACIONES[version:]:
+                migracion(conexion)
+        for tabla in Base.metadata.sorted_tables:
+            for indice in tabla.indexes:
+                indice.create(bind=conexion, checkfirst=True)
+        for trigger in TRIGGERS_CAMBIOS:
+            conexion.execute(text(trigger))
+        conexion.execute(text(f"PRAGMA user_version = {len(MIGRACIONES)}"))
+
+
 # Inicialización de la Base de Datos
+# Se ejecuta una sola vez por proceso, no en cada rerun de Streamlit
+@st.cache_resource(show_spinner=False)
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    migrar_esquema()
     db = SessionLocal()
     try:
         # Insertar categorías de ejemplo
@@ -160,6 +587,11 @@ def init_db():
             db.add_all(gastos)
             db.commit()
 
+        # Calcular las estadísticas por primera vez (bases nuevas o creadas antes de existir la tabla)
+        if db.query(Gasto).first() and not db.query(EstadisticaGasto).first():
+            EstadisticaUseCase.reconstruir(db)
+            db.commit()
+
     except Exception as e:
         db.rollback()
         print(f"Error al inicializar la base de datos: {e}")
@@ -167,284 +599,1876 @@ def init_db():
         db.close()
 
 
+# Formatos de Intercambio
+COLUMNAS_REPORTE = ['ID', 'Fecha', 'Monto', 'Moneda', 'Descripción', 'Categoría', 'Método de Pago', 'Monto Base']
+COLUMNAS_IMPORTACION = ['Fecha', 'Monto', 'Descripción', 'Categoría', 'Método de Pago']
+COLUMNAS_CAMBIOS = ['Secuencia', 'Operación'] + COLUMNAS_REPORTE
+FORMATO_FECHA = "%Y-%m-%d %H:%M:%S"
+TAMANO_LOTE = 10_000
+TOP_GASTOS = 50
+
+
+@dataclass
+class ResultadoTransferencia:
+    filas: int
+    segundos: float
+    omitidas: int = 0
+    duplicadas: int = 0
+    # Filas del archivo con la fecha vacía; las que se insertan llevan la fecha de la importación
+    sin_fecha: int = 0
+    # Marca del registro de cambios vigente en la instantánea exportada (solo en exportaciones completas)
+    marca: int = None
+
+    @property
+    def filas_por_segundo(self) -> float:
+        return self.filas / self.segundos if self.segundos > 0 else float(self.filas)
+
+    def __str__(self):
+        return f"{self.filas} filas en {self.segundos:.2f} s ({self.filas_por_segundo:,.0f} filas/s)"
+
+
+class FormatoExcel:
+    extension = 'xlsx'
+    mime = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    def leer(self, archivo, tamano_lote: int) -> Iterator[pd.DataFrame]:
+        libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+        try:
+            filas = libro.active.iter_rows(values_only=True)
+            columnas = next(filas, None)
+            if columnas is None:
+                return
+            lote = []
+            for fila in filas:
+                lote.append(fila)
+                if len(lote) >= tamano_lote:
+                    yield pd.DataFrame(lote, columns=columnas)
+                    lote = []
+            if lote:
+                yield pd.DataFrame(lote, columns=columnas)
+        finally:
+            libro.close()
+
+    def escribir(self, destino, lotes: Iterator[pd.DataFrame], columnas: list) -> None:
+        self.escribir_libro(destino, [('Gastos', lotes, columnas)])
+
+    def escribir_libro(self, destino, hojas: list) -> None:
+        """Escribe un libro de varias hojas en modo streaming; ``hojas`` es una lista de (nombre, lotes, columnas)."""
+        libro = openpyxl.Workbook(write_only=True)
+        for nombre, lotes, columnas in hojas:
+            self.agregar_hoja(libro, nombre, lotes, columnas)
+        libro.save(destino)
+
+    @staticmethod
+    def agregar_hoja(libro, nombre: str, lotes: Iterator[pd.DataFrame], columnas: list) -> None:
+        hoja = libro.create_sheet(nombre)
+        hoja.append(columnas)
+        for lote in lotes:
+            for fila in lote.itertuples(index=False, name=None):
+                hoja.append(fila)
+
+
+class FormatoCsv:
+    extension = 'csv'
+    mime = 'text/csv'
+
+    def leer(self, archivo, tamano_lote: int) -> Iterator[pd.DataFrame]:
+        yield from pd.read_csv(archivo, chunksize=tamano_lote)
+
+    def escribir(self, destino, lotes: Iterator[pd.DataFrame], columnas: list) -> None:
+        if isinstance(destino, (str, os.PathLike)):
+            with open(destino, 'w', encoding='utf-8', newline='') as texto:
+                self._escribir_texto(texto, lotes, columnas)
+        else:
+            texto = io.TextIOWrapper(destino, encoding='utf-8', newline='')
+            try:
+                self._escribir_texto(texto, lotes, columnas)
+            finally:
+                texto.flush()
+                texto.detach()
+
+    @staticmethod
+    def _escribir_texto(texto, lotes: Iterator[pd.DataFrame], columnas: list) -> None:
+        encabezado = True
+        for lote in lotes:
+            lote.to_csv(texto, index=False, header=encabezado)
+            encabezado = False
+        if encabezado:
+            pd.DataFrame(columns=columnas).to_csv(texto, index=False)
+
+
+class FormatoParquet:
+    extension = 'parquet'
+    mime = 'application/vnd.apache.parquet'
+    tipos = {'Secuencia': 'int64', 'ID': 'int64', 'Monto': 'float64', 'Monto Base': 'float64', 'Tasa': 'float64'}
+
+    def leer(self, archivo, tamano_lote: int) -> Iterator[pd.DataFrame]:
+        for lote in pq.ParquetFile(archivo).iter_batches(batch_size=tamano_lote):
+            yield lote.to_pandas()
+
+    def escribir(self, destino, lotes: Iterator[pd.DataFrame], columnas: list) -> None:
+        esquema = pa.schema([(columna, pa.type_for_alias(self.tipos.get(columna, 'string'))) for columna in columnas])
+        with pq.ParquetWriter(destino, esquema) as escritor:
+            for lote in lotes:
+                escritor.write_table(pa.Table.from_pandas(lote, schema=esquema, preserve_index=False))
+
+
+FORMATOS = {formato.extension: formato for formato in (FormatoExcel(), FormatoCsv())}
+if pq is not None:
+    FORMATOS[FormatoParquet.extension] = FormatoParquet()
+
+
+def obtener_formato(nombre: str):
+    formato = FORMATOS.get(nombre.lower().lstrip('.'))
+    if not formato:
+        raise ValueError(f"Formato no soportado: {nombre}. Disponibles: {', '.join(FORMATOS)}")
+    return formato
+
+
+# Escritura Serializada
+# SQLite admite un solo escritor a la vez. Las escrituras de los casos de uso se encolan y un único hilo las
+# aplica, agrupando las pendientes en una sola transacción con un SAVEPOINT por operación
+ESCRITURA_SERIALIZADA = True
+MAXIMO_GRUPO_ESCRITURAS = 64
+# Tiempo máximo que una sesión espera el resultado de su escritura (incluye la espera en la cola)
+ESPERA_ESCRITURA_SEGUNDOS = 300
+
+
+class EscritorSerializado:
+    def __init__(self, maximo_grupo: int = MAXIMO_GRUPO_ESCRITURAS):
+        self.maximo_grupo = maximo_grupo
+        self.cola = queue.Queue()
+        self.hilo = threading.Thread(target=self._ciclo, name="escritor-gastomagico", daemon=True)
+        self.hilo.start()
+
+    def enviar(self, operacion, *args, **kwargs) -> Future:
+        """Encola ``operacion(db, *args, **kwargs)``; el futuro se resuelve después del commit de su grupo."""
+        futuro = Future()
+        self.cola.put((operacion, args, kwargs, futuro))
+        return futuro
+
+    def _ciclo(self) -> None:
+        while True:
+            grupo = [self.cola.get()]
+            while len(grupo) < self.maximo_grupo:
+                try:
+                    grupo.append(self.cola.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._aplicar(grupo)
+            except Exception as e:
+                # El hilo no debe morir: si muere, todas las escrituras posteriores quedarían esperando
+                self._fallar(grupo, e)
+
+    @staticmethod
+    def _fallar(grupo: list, error: Exception) -> None:
+        for _, _, _, futuro in grupo:
+            if not futuro.done():
+                futuro.set_exception(error)
+
+    @staticmethod
+    def _aplicar(grupo: list) -> None:
+        resultados = []
+        db = None
+        try:
+            # BEGIN IMMEDIATE puede fallar si otra conexión retiene el bloqueo más que el busy_timeout
+            db = sesion_escritura()
+            for operacion, args, kwargs, futuro in grupo:
+                if not futuro.set_running_or_notify_cancel():
+                    continue
+                # Un error solo deshace su propia operación, no las demás del grupo
+                punto = db.begin_nested()
+                try:
+                    resultado = operacion(db, *args, **kwargs)
+                    punto.commit()
+                except Exception as e:
+                    punto.rollback()
+                    resultados.append((futuro, None, e))
+                else:
+                    resultados.append((futuro, resultado, None))
+            db.commit()
+        except Exception as e:
+            if db is not None:
+                db.rollback()
+            EscritorSerializado._fallar(grupo, e)
+            return
+        finally:
+            if db is not None:
+                db.close()
+        for futuro, resultado, error in resultados:
+            if error is not None:
+                futuro.set_exception(error)
+            else:
+                futuro.set_result(resultado)
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_escritor() -> EscritorSerializado:
+    # Un solo escritor por proceso, compartido por todas las sesiones de Streamlit
+    return EscritorSerializado()
+
+
+def sesion_escritura():
+    """Sesión cuya transacción empieza con BEGIN IMMEDIATE (ver ``crear_motor``); admite un solo commit."""
+    db = SessionLocal()
+    db.connection(execution_options={'escritura': True})
+    return db
+
+
+def escribir(operacion, *args, **kwargs):
+    """Ejecuta ``operacion(db, ...)`` en una transacción y devuelve su resultado (o propaga su error).
+
+    Todas las escrituras de los casos de uso pasan por aquí.
+    """
+    # Las lecturas siguientes del mismo rerun deben ver esta escritura
+    olvidar_version()
+    if ESCRITURA_SERIALIZADA:
+        futuro = obtener_escritor().enviar(operacion, *args, **kwargs)
+        try:
+            return futuro.result(timeout=ESPERA_ESCRITURA_SEGUNDOS)
+        except FuturesTimeoutError:
+            # Si todavía no empezó, se descarta; si ya empezó, terminará pero la sesión no espera su resultado
+            futuro.cancel()
+            raise TimeoutError(f"La escritura no terminó en {ESPERA_ESCRITURA_SEGUNDOS} s; "
+                               f"la base de datos puede estar bloqueada por otro proceso.")
+    db = sesion_escritura()
+    try:
+        resultado = operacion(db, *args, **kwargs)
+        db.commit()
+        return resultado
+    except Exception as e:
+        db.rollback()
+        raise e
+    finally:
+        db.close()
+
+
+# Trazas y Métricas
+# Cada método de los casos de uso registra su latencia en un histograma, las filas que devuelve y los errores.
+# Una fracción de las llamadas se perfila con cProfile y se conserva el perfil si superó el umbral
+LIMITES_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MUESTREO_PERFIL = 0.1
+UMBRAL_PERFIL_SEGUNDOS = 0.5
+PERFILES_CONSERVADOS = 20
+METRICAS_PATH = os.path.join(BASE_DIR, 'metricas.prom')
+
+
+@dataclass
+class MetricaOperacion:
+    llamadas: int = 0
+    errores: int = 0
+    filas: int = 0
+    segundos: float = 0.0
+    maximo: float = 0.0
+    cubetas: list = None
+
+    def __post_init__(self):
+        if self.cubetas is None:
+            self.cubetas = [0] * (len(LIMITES_LATENCIA) + 1)
+
+    def cuantil(self, q: float) -> float:
+        """Estimación del cuantil interpolando dentro de la cubeta, como ``histogram_quantile`` de Prometheus."""
+        if not self.llamadas:
+            return 0.0
+        objetivo = q * self.llamadas
+        acumulado, inferior = 0, 0.0
+        for limite, cantidad in zip(LIMITES_LATENCIA + (self.maximo,), self.cubetas):
+            if cantidad and acumulado + cantidad >= objetivo:
+                return min(self.maximo, inferior + (limite - inferior) * (objetivo - acumulado) / cantidad)
+            acumulado += cantidad
+            inferior = limite
+        return self.maximo
+
+
+class PerfilLento(NamedTuple):
+    operacion: str
+    segundos: float
+    registrado_en: datetime
+    estadisticas: str
+
+
+class RegistroMetricas:
+    def __init__(self):
+        self._candado = threading.Lock()
+        self._local = threading.local()
+        self.operaciones = {}
+        self.perfiles = deque(maxlen=PERFILES_CONSERVADOS)
+
+    def registrar(self, operacion: str, segundos: float, filas: int = 0, error: bool = False) -> None:
+        with self._candado:
+            metrica = self.operaciones.setdefault(operacion, MetricaOperacion())
+            metrica.llamadas += 1
+            metrica.errores += error
+            metrica.filas += filas
+            metrica.segundos += segundos
+            metrica.maximo = max(metrica.maximo, segundos)
+            metrica.cubetas[bisect.bisect_left(LIMITES_LATENCIA, segundos)] += 1
+
+    def medir(self, operacion: str, funcion, *args, **kwargs):
+        # cProfile admite un solo perfilador por hilo: solo se perfila la llamada más externa
+        profundidad = getattr(self._local, 'profundidad', 0)
+        perfil = cProfile.Profile() if profundidad == 0 and random.random() < MUESTREO_PERFIL else None
+        self._local.profundidad = profundidad + 1
+        inicio = time.perf_counter()
+        resultado, error = None, False
+        try:
+            if perfil:
+                try:
+                    perfil.enable()
+                except ValueError:  # otro hilo ya está perfilando (Python 3.12+)
+                    perfil = None
+            resultado = funcion(*args, **kwargs)
+            return resultado
+        except Exception:
+            error = True
+            raise
+        finally:
+            if perfil:
+                perfil.disable()
+            segundos = time.perf_counter() - inicio
+            self._local.profundidad = profundidad
+            self.registrar(operacion, segundos, contar_filas(resultado), error)
+            if perfil and segundos >= UMBRAL_PERFIL_SEGUNDOS:
+                texto = io.StringIO()
+                pstats.Stats(perfil, stream=texto).sort_stats('cumulative').print_stats(25)
+                with self._candado:
+                    self.perfiles.appendleft(PerfilLento(operacion, segundos, datetime.now(), texto.getvalue()))
+
+    def resumen(self) -> pd.DataFrame:
+        with self._candado:
+            operaciones = sorted(self.operaciones.items(), key=lambda item: item[1].segundos, reverse=True)
+            return pd.DataFrame([{
+                'Operación': operacion,
+                'Llamadas': metrica.llamadas,
+                'Errores': metrica.errores,
+                'Filas': metrica.filas,
+                'Total (s)': round(metrica.segundos, 3),
+                'Media (ms)': round(metrica.segundos / metrica.llamadas * 1000, 2),
+                'p50 (ms)': round(metrica.cuantil(0.5) * 1000, 2),
+                'p95 (ms)': round(metrica.cuantil(0.95) * 1000, 2),
+                'p99 (ms)': round(metrica.cuantil(0.99) * 1000, 2),
+                'Máximo (ms)': round(metrica.maximo * 1000, 2),
+            } for operacion, metrica in operaciones])
+
+    def exportar_prometheus(self) -> str:
+        """Métricas en el formato de texto de Prometheus (apto para el textfile collector de node_exporter)."""
+        lineas = [
+            "# HELP gastomagico_operacion_segundos Latencia de los métodos de los casos de uso.",
+            "# TYPE gastomagico_operacion_segundos histogram",
+        ]
+        with self._candado:
+            operaciones = sorted(self.operaciones.items())
+            for operacion, metrica in operaciones:
+                acumulado = 0
+                for limite, cantidad in zip(LIMITES_LATENCIA, metrica.cubetas):
+                    acumulado += cantidad
+                    lineas.append(f'gastomagico_operacion_segundos_bucket{{operacion="{operacion}",le="{limite}"}} '
+                                  f'{acumulado}')
+                lineas.append(f'gastomagico_operacion_segundos_bucket{{operacion="{operacion}",le="+Inf"}} '
+                              f'{metrica.llamadas}')
+                lineas.append(f'gastomagico_operacion_segundos_sum{{operacion="{operacion}"}} {metrica.segundos}')
+                lineas.append(f'gastomagico_operacion_segundos_count{{operacion="{operacion}"}} {metrica.llamadas}')
+            for nombre, ayuda, campo in (
+                ('filas', 'Filas devueltas o procesadas.', 'filas'),
+                ('errores', 'Llamadas que terminaron con una excepción.', 'errores'),
+            ):
+                lineas.append(f"# HELP gastomagico_operacion_{nombre}_total {ayuda}")
+                lineas.append(f"# TYPE gastomagico_operacion_{nombre}_total counter")
+                for operacion, metrica in operaciones:
+                    lineas.append(f'gastomagico_operacion_{nombre}_total{{operacion="{operacion}"}} '
+                                  f'{getattr(metrica, campo)}')
+        return "\n".join(lineas) + "\n"
+
+    def escribir_prometheus(self, ruta: str = METRICAS_PATH) -> str:
+        # Se escribe a un temporal y se renombra para que el recolector nunca lea un archivo a medias
+        temporal = f"{ruta}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as archivo:
+            archivo.write(self.exportar_prometheus())
+        os.replace(temporal, ruta)
+        return ruta
+
+    def reiniciar(self) -> None:
+        with self._candado:
+            self.operaciones.clear()
+            self.perfiles.clear()
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_metricas() -> RegistroMetricas:
+    # Un solo registro por proceso, que sobrevive a los reruns de Streamlit
+    return RegistroMetricas()
+
+
+def contar_filas(resultado) -> int:
+    if isinstance(resultado, (ResultadoTransferencia, PaginaGastos)):
+        return resultado.filas if isinstance(resultado.filas, int) else len(resultado.filas)
+    if isinstance(resultado, (list, dict, pd.DataFrame)):
+        return len(resultado)
+    if isinstance(resultado, int) and not isinstance(resultado, bool):
+        return resultado
+    return 0
+
+
+def trazar_metodos(clase):
+    """Decorador de clase: mide los métodos públicos de un caso de uso.
+
+    Se omiten los privados y los que reciben la sesión ``db`` del llamador: se ejecutan dentro de otra operación
+    ya medida (a veces en ciclos) y solo agregarían costo y ruido a los histogramas.
+    """
+    metricas = obtener_metricas()
+
+    def envolver(funcion, operacion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            return metricas.medir(operacion, funcion, *args, **kwargs)
+        return envoltura
+
+    for nombre, atributo in list(vars(clase).items()):
+        if not isinstance(atributo, staticmethod) or nombre.startswith('_'):
+            continue
+        funcion = atributo.__func__
+        parametros = list(signature(funcion).parameters)
+        # Los generadores se consumen fuera de la llamada: medirlos solo registraría su creación
+        if not isgeneratorfunction(funcion) and parametros[:1] != ['db']:
+            setattr(clase, nombre, staticmethod(envolver(funcion, f"{clase.__name__}.{nombre}")))
+    return clase
+
+
 # Casos de Uso
+MODOS_ELIMINACION = ('bloquear', 'cascada', 'reasignar')
+
+
+@trazar_metodos
 class TablaUseCase:
     @staticmethod
     def agregar_categoria(nombre: str) -> None:
+        escribir(TablaUseCase._agregar_categoria, nombre)
+
+    @staticmethod
+    def _agregar_categoria(db, nombre: str) -> None:
+        db.add(Categoria(nombre=nombre))
+        db.flush()
+        registrar_escritura(db)
+
+    @staticmethod
+    def listar_categorias():
         db = SessionLocal()
         try:
-            categoria = Categoria(nombre=nombre)
-            db.add(categoria)
-            db.commit()
-            db.refresh(categoria)
-        except Exception as e:
-            db.rollback()
-            raise e
+            return [CategoriaFila._make(fila) for fila in
+                    db.execute(select(Categoria.id, Categoria.nombre).order_by(Categoria.id))]
         finally:
             db.close()
 
     @staticmethod
-    def listar_categorias():
+    def eliminar_categoria(id_categoria: int, modo: str = 'bloquear', destino_id: int = None) -> int:
+        return escribir(TablaUseCase._eliminar_con_gastos, Categoria, Gasto.categoria_id, id_categoria, modo,
+                        destino_id, "Categoría no encontrada.")
+
+    @staticmethod
+    def agregar_metodo_pago(nombre: str) -> None:
+        escribir(TablaUseCase._agregar_metodo_pago, nombre)
+
+    @staticmethod
+    def _agregar_metodo_pago(db, nombre: str) -> None:
+        db.add(MetodoPago(nombre=nombre))
+        db.flush()
+        registrar_escritura(db)
+
+    @staticmethod
+    def listar_metodos_pago():
         db = SessionLocal()
         try:
-            return db.query(Categoria).all()
+            return [MetodoPagoFila._make(fila) for fila in
+                    db.execute(select(MetodoPago.id, MetodoPago.nombre).order_by(MetodoPago.id))]
         finally:
             db.close()
 
     @staticmethod
-    def eliminar_categoria(id_categoria: int) -> None:
+    def eliminar_metodo_pago(id_metodo: int, modo: str = 'bloquear', destino_id: int = None) -> int:
+        return escribir(TablaUseCase._eliminar_con_gastos, MetodoPago, Gasto.metodo_pago_id, id_metodo, modo,
+                        destino_id, "Método de pago no encontrado.")
+
+    @staticmethod
+    def _eliminar_con_gastos(db, modelo, columna, id_registro: int, modo: str, destino_id,
+                             error_no_encontrado: str) -> int:
+        """Elimina una categoría o método de pago resolviendo sus gastos con una sola sentencia.
+
+        Devuelve la cantidad de gastos que se borraron al reasignar por quedar repetidos.
+
+        - cascada: borra los gastos asociados y desactiva las reglas recurrentes que lo usan, quitándoles la referencia.
+        - reasignar: mueve los gastos y las reglas recurrentes a ``destino_id``; los gastos importados que quedarían
+          idénticos a otro importado se borran.
+        - bloquear: falla si existe algún gasto o regla recurrente asociada.
+        """
+        if modo not in MODOS_ELIMINACION:
+            raise ValueError(f"Modo de eliminación no válido: {modo}")
+        if not db.execute(select(exists().where(modelo.id == id_registro))).scalar():
+            raise ValueError(error_no_encontrado)
+        asociados = Gasto.__table__.c[columna.key] == id_registro
+        reglas = GastoRecurrente.__table__
+        reglas_asociadas = reglas.c[columna.key] == id_registro
+        dimension = 'categoria' if columna.key == 'categoria_id' else 'metodo_pago'
+        otras = {k: v for k, v in DIMENSIONES_ESTADISTICAS.items() if k != dimension}
+        repetidos_eliminados = 0
+
+        if modo == 'bloquear':
+            if db.execute(select(exists().where(asociados))).scalar():
+                raise ValueError("No se puede eliminar: tiene gastos asociados.")
+            if db.execute(select(exists().where(reglas_asociadas))).scalar():
+                raise ValueError("No se puede eliminar: tiene gastos recurrentes asociados.")
+        elif modo == 'cascada':
+            EstadisticaUseCase.ajustar(db, asociados, signo=-1, dimensiones=otras)
+            db.execute(delete(Gasto.__table__).where(asociados))
+            db.execute(update(reglas).where(reglas_asociadas).values({
+                columna.key: None,
+                'activo': False,
+                'updated_at': datetime.utcnow(),
+            }))
+        else:
+            if destino_id is None or destino_id == id_registro:
+                raise ValueError("Seleccione un destino distinto para reasignar los gastos.")
+            if not db.execute(select(exists().where(modelo.id == destino_id))).scalar():
+                raise ValueError("El destino de la reasignación no existe.")
+            tabla = Gasto.__table__
+            claves = {'categoria_id': tabla.c.categoria_id, 'metodo_pago_id': tabla.c.metodo_pago_id}
+            claves[columna.key] = destino_id
+            nuevo_hash = func.hash_gasto(tabla.c.fecha, tabla.c.monto, tabla.c.descripcion,
+                                         claves['categoria_id'], claves['metodo_pago_id'], tabla.c.moneda)
+            importados = tabla.c.hash_contenido.is_not(None)
+            duplicados = select(tabla.c.hash_contenido).where(importados)
+            repetidos = asociados & importados & nuevo_hash.in_(duplicados)
+            EstadisticaUseCase.ajustar(db, repetidos, signo=-1)
+            repetidos_eliminados = db.execute(delete(tabla).where(repetidos)).rowcount
+            EstadisticaUseCase.trasladar(db, asociados, dimension, id_registro, destino_id)
+            db.execute(update(tabla).where(asociados).values({
+                columna.key: destino_id,
+                'hash_contenido': case((importados, nuevo_hash)),
+                'updated_at': datetime.utcnow(),
+            }))
+            db.execute(update(reglas).where(reglas_asociadas).values({
+                columna.key: destino_id,
+                'updated_at': datetime.utcnow(),
+            }))
+
+        EstadisticaUseCase.olvidar(db, dimension, id_registro)
+        db.execute(delete(modelo.__table__).where(modelo.__table__.c.id == id_registro))
+        registrar_escritura(db)
+        return repetidos_eliminados
+
+    @staticmethod
+    def cargar_tipos_cambio(archivo, formato: str = 'csv', tamano_lote: int = TAMANO_LOTE) -> ResultadoTransferencia:
+        """Carga tipos de cambio desde un archivo con columnas Moneda, Fecha y Tasa.
+
+        La tasa es el valor de una unidad de la moneda en la moneda base actual, que se guarda con cada tasa; las
+        filas existentes se sobrescriben.
+        """
+        return escribir(TablaUseCase._cargar_tipos_cambio, archivo, formato, tamano_lote)
+
+    @staticmethod
+    def _cargar_tipos_cambio(db, archivo, formato: str, tamano_lote: int) -> ResultadoTransferencia:
+        handler = obtener_formato(formato)
+        sentencia = sqlite_insert(TipoCambio.__table__)
+        sentencia = sentencia.on_conflict_do_update(
+            index_elements=[TipoCambio.moneda, TipoCambio.moneda_base, TipoCambio.fecha],
+            set_={'tasa': sentencia.excluded.tasa, 'updated_at': sentencia.excluded.updated_at}
+        )
+        moneda_base = ReporteUseCase.moneda_base(db)
+        inicio = time.perf_counter()
+        filas = omitidas = 0
+        for lote in handler.leer(archivo, tamano_lote):
+            faltantes = [columna for columna in ('Moneda', 'Fecha', 'Tasa') if columna not in lote.columns]
+            if faltantes:
+                raise ValueError(f"Faltan columnas en el archivo: {', '.join(faltantes)}")
+            registros = pd.DataFrame({
+                'moneda': lote['Moneda'].astype(str).str.strip().str.upper(),
+                'fecha': pd.to_datetime(lote['Fecha'], errors='coerce').dt.date,
+                'tasa': pd.to_numeric(lote['Tasa'], errors='coerce'),
+            }).dropna()
+            registros = registros[(registros['tasa'] > 0) & (registros['moneda'] != moneda_base)]
+            registros['moneda_base'] = moneda_base
+            omitidas += len(lote) - len(registros)
+            if not registros.empty:
+                db.execute(sentencia, registros.to_dict('records'))
+                filas += len(registros)
+        # Los montos convertidos cambian con las tasas: se recalculan las estadísticas
+        EstadisticaUseCase.reconstruir(db)
+        registrar_escritura(db)
+        return ResultadoTransferencia(filas, time.perf_counter() - inicio, omitidas)
+
+    @staticmethod
+    def listar_monedas() -> list:
+        """Moneda base seguida de las monedas con tipo de cambio cargado."""
         db = SessionLocal()
         try:
-            categoria = db.query(Categoria).filter(Categoria.id == id_categoria).first()
-            if not categoria:
-                raise ValueError("Categoría no encontrada.")
-            db.delete(categoria)
-            db.commit()
-        except Exception as e:
-            db.rollback()
-            raise e
+            base = ReporteUseCase.moneda_base(db)
+            otras = db.execute(
+                select(TipoCambio.moneda).distinct().where(TipoCambio.moneda_base == base).order_by(TipoCambio.moneda)
+            ).scalars()
+            return [base] + list(otras)
         finally:
             db.close()
 
     @staticmethod
-    def agregar_metodo_pago(nombre: str) -> None:
+    def agregar_frase(texto: str) -> None:
+        escribir(TablaUseCase._agregar_frase, texto)
+
+    @staticmethod
+    def _agregar_frase(db, texto: str) -> None:
+        db.add(FraseMotivacional(texto=texto))
+        db.flush()
+        registrar_escritura(db)
+
+    @staticmethod
+    def listar_frases():
         db = SessionLocal()
         try:
-            metodo_pago = MetodoPago(nombre=nombre)
-            db.add(metodo_pago)
-            db.commit()
-            db.refresh(metodo_pago)
-        except Exception as e:
-            db.rollback()
-            raise e
+            return [FraseFila._make(fila) for fila in db.execute(select(FraseMotivacional.id, FraseMotivacional.texto))]
         finally:
             db.close()
 
+
+ORDENES_GASTOS = {
+    'fecha': Gasto.fecha,
+    'monto': Gasto.monto,
+    'descripcion': Gasto.descripcion,
+    'id': Gasto.id,
+}
+
+
+@trazar_metodos
+class GastoUseCase:
     @staticmethod
-    def listar_metodos_pago():
+    def agregar_gasto(descripcion: str, monto: float, categoria_id: int, metodo_pago_id: int, fecha=None,
+                      moneda: str = None):
+        """Registra un gasto y devuelve su evaluación frente a las estadísticas de la categoría (o None)."""
+        return escribir(GastoUseCase._agregar_gasto, descripcion, monto, categoria_id, metodo_pago_id, fecha, moneda)
+
+    @staticmethod
+    def _agregar_gasto(db, descripcion: str, monto: float, categoria_id: int, metodo_pago_id: int, fecha,
+                       moneda: str):
+        gasto = Gasto(
+            descripcion=descripcion,
+            monto=monto,
+            categoria_id=categoria_id,
+            metodo_pago_id=metodo_pago_id,
+            fecha=fecha,
+            moneda=(moneda or ReporteUseCase.moneda_base(db)).upper()
+        )
+        db.add(gasto)
+        db.flush()
+        evaluacion = EstadisticaUseCase.evaluar(db, gasto.id, categoria_id)
+        EstadisticaUseCase.ajustar(db, Gasto.id == gasto.id)
+        registrar_escritura(db)
+        return evaluacion
+
+    @staticmethod
+    def listar_gastos():
         db = SessionLocal()
         try:
-            return db.query(MetodoPago).all()
+            return [GastoFila._make(fila) for fila in db.execute(consulta_gasto_filas().order_by(Gasto.id))]
         finally:
             db.close()
 
     @staticmethod
-    def eliminar_metodo_pago(id_metodo: int) -> None:
+    def obtener_gasto(id_gasto: int):
+        """Un gasto por su clave primaria, o None si no existe."""
         db = SessionLocal()
         try:
-            metodo_pago = db.query(MetodoPago).filter(MetodoPago.id == id_metodo).first()
-            if not metodo_pago:
-                raise ValueError("Método de pago no encontrado.")
-            db.delete(metodo_pago)
-            db.commit()
-        except Exception as e:
-            db.rollback()
-            raise e
+            fila = db.execute(consulta_gasto_filas().where(Gasto.id == id_gasto)).first()
+            return GastoFila._make(fila) if fila else None
         finally:
             db.close()
 
     @staticmethod
-    def agregar_frase(texto: str) -> None:
+    def eliminar_gasto(id_gasto: int) -> None:
+        escribir(GastoUseCase._eliminar_gasto, id_gasto)
+
+    @staticmethod
+    def _eliminar_gasto(db, id_gasto: int) -> None:
+        gasto = db.get(Gasto, id_gasto)
+        if not gasto:
+            raise ValueError("Gasto no encontrado.")
+        EstadisticaUseCase.ajustar(db, Gasto.id == id_gasto, signo=-1)
+        db.delete(gasto)
+        db.flush()
+        registrar_escritura(db)
+
+    @staticmethod
+    def actualizar_gasto(id_gasto: int, descripcion: str, monto: float, categoria_id: int, metodo_pago_id: int,
+                         fecha=None, moneda: str = None) -> None:
+        escribir(GastoUseCase._actualizar_gasto, id_gasto, descripcion, monto, categoria_id, metodo_pago_id, fecha,
+                 moneda)
+
+    @staticmethod
+    def _actualizar_gasto(db, id_gasto: int, descripcion: str, monto: float, categoria_id: int,
+                          metodo_pago_id: int, fecha, moneda: str) -> None:
+        gasto = db.get(Gasto, id_gasto)
+        if not gasto:
+            raise ValueError("Gasto no encontrado.")
+        EstadisticaUseCase.ajustar(db, Gasto.id == id_gasto, signo=-1)
+        gasto.descripcion = descripcion
+        gasto.monto = monto
+        gasto.categoria_id = categoria_id
+        gasto.metodo_pago_id = metodo_pago_id
+        gasto.fecha = fecha
+        if moneda:
+            gasto.moneda = moneda.upper()
+        try:
+            db.flush()
+        except IntegrityError:
+            raise ValueError("Ya existe un gasto importado idéntico registrado.")
+        EstadisticaUseCase.ajustar(db, Gasto.id == id_gasto)
+        registrar_escritura(db)
+
+    @staticmethod
+    def _condiciones_filtro(fecha_desde=None, fecha_hasta=None, categoria_ids=None, metodo_pago_ids=None,
+                            monto_min=None, monto_max=None) -> list:
+        condiciones = []
+        if fecha_desde:
+            condiciones.append(Gasto.fecha >= fecha_desde)
+        if fecha_hasta:
+            if isinstance(fecha_hasta, datetime):
+                condiciones.append(Gasto.fecha <= fecha_hasta)
+            else:
+                # Una fecha sin hora incluye el día completo
+                condiciones.append(Gasto.fecha < fecha_hasta + timedelta(days=1))
+        if categoria_ids:
+            condiciones.append(Gasto.categoria_id.in_(list(categoria_ids)))
+        if metodo_pago_ids:
+            condiciones.append(Gasto.metodo_pago_id.in_(list(metodo_pago_ids)))
+        if monto_min is not None:
+            condiciones.append(Gasto.monto >= monto_min)
+        if monto_max is not None:
+            condiciones.append(Gasto.monto <= monto_max)
+        return condiciones
+
+    @staticmethod
+    def filtrar_gastos(fecha_desde=None, fecha_hasta=None, categoria_ids=None, metodo_pago_ids=None,
+                       monto_min=None, monto_max=None, orden: str = 'fecha', descendente: bool = True,
+                       pagina: int = 1, tamano_pagina: int = 50) -> PaginaGastos:
+        """Filtra y pagina los gastos en una sola consulta; ``tamano_pagina=None`` devuelve todos."""
+        if orden not in ORDENES_GASTOS:
+            raise ValueError(f"Orden no válido: {orden}")
+        condiciones = GastoUseCase._condiciones_filtro(fecha_desde, fecha_hasta, categoria_ids, metodo_pago_ids,
+                                                       monto_min, monto_max)
+        columna = ORDENES_GASTOS[orden]
         db = SessionLocal()
         try:
-            frase = FraseMotivacional(texto=texto)
-            db.add(frase)
-            db.commit()
-            db.refresh(frase)
-        except Exception as e:
-            db.rollback()
-            raise e
+            total = db.execute(select(func.count()).select_from(Gasto).where(*condiciones)).scalar()
+            query = consulta_gasto_filas().where(*condiciones).order_by(
+                columna.desc() if descendente else columna.asc(),
+                Gasto.id.desc() if descendente else Gasto.id.asc()
+            )
+            pagina = max(1, pagina)
+            if tamano_pagina:
+                query = query.limit(tamano_pagina).offset((pagina - 1) * tamano_pagina)
+            filas = [GastoFila._make(fila) for fila in db.execute(query)]
+            return PaginaGastos(filas, total, pagina, tamano_pagina)
         finally:
             db.close()
 
+
+@trazar_metodos
+class ReporteUseCase:
     @staticmethod
-    def listar_frases():
+    def _consulta_reporte(monto_base):
+        """Filas con las columnas de ``COLUMNAS_REPORTE``."""
+        return select(
+            Gasto.id,
+            func.strftime(FORMATO_FECHA, Gasto.fecha),
+            Gasto.monto,
+            Gasto.moneda,
+            Gasto.descripcion,
+            func.coalesce(Categoria.nombre, ''),
+            func.coalesce(MetodoPago.nombre, ''),
+            func.round(monto_base, 2)
+        ).outerjoin(Categoria, Gasto.categoria_id == Categoria.id) \
+            .outerjoin(MetodoPago, Gasto.metodo_pago_id == MetodoPago.id)
+
+    @staticmethod
+    def _lotes_consulta(db, consulta, columnas: list, tamano_lote: int) -> Iterator[pd.DataFrame]:
+        resultado = db.execute(consulta, execution_options={'stream_results': True, 'yield_per': tamano_lote})
+        for filas in resultado.partitions():
+            yield pd.DataFrame(filas, columns=columnas)
+
+    @staticmethod
+    def _lotes_gastos(db, tamano_lote: int) -> Iterator[pd.DataFrame]:
+        consulta = ReporteUseCase._consulta_reporte(monto_en_base(ReporteUseCase.moneda_base(db))).order_by(Gasto.id)
+        yield from ReporteUseCase._lotes_consulta(db, consulta, COLUMNAS_REPORTE, tamano_lote)
+
+    @staticmethod
+    def _hojas_resumen(db, tamano_lote: int, top: int) -> list:
+        """Hojas de análisis del libro Excel; cada una sale de una sola consulta agrupada en SQL."""
+        monto_base = monto_en_base(ReporteUseCase.moneda_base(db))
+        mes = func.strftime('%Y-%m', Gasto.fecha)
+        hojas = []
+
+        mensual = select(
+            func.coalesce(mes, 'Sin fecha').label('mes'),
+            func.count(Gasto.id),
+            func.round(func.total(monto_base), 2),
+            func.round(func.avg(monto_base), 2),
+            func.round(func.min(monto_base), 2),
+            func.round(func.max(monto_base), 2)
+        ).group_by(mes).order_by(mes)
+        columnas = ['Mes', 'Gastos', 'Total', 'Promedio', 'Mínimo', 'Máximo']
+        hojas.append(('Resumen Mensual', ReporteUseCase._lotes_consulta(db, mensual, columnas, tamano_lote), columnas))
+
+        # Tablas cruzadas: se agrupa primero por (clave, mes) y luego se pivotea un mes por columna
+        meses = list(db.execute(select(mes).distinct().order_by(mes)).scalars())
+        for titulo, modelo, columna, sin_valor in (
+            ('Categoría x Mes', Categoria, Gasto.categoria_id, 'Sin categoría'),
+            ('Método x Mes', MetodoPago, Gasto.metodo_pago_id, 'Sin método de pago'),
+        ):
+            parcial = select(
+                columna.label('clave'), mes.label('mes'), func.total(monto_base).label('total')
+            ).group_by(columna, mes).subquery()
+            por_mes = [
+                func.round(func.total(case(
+                    (parcial.c.mes.is_(None) if valor is None else parcial.c.mes == valor, parcial.c.total),
+                    else_=0
+                )), 2)
+                for valor in meses
+            ]
+            nombre = func.coalesce(modelo.nombre, sin_valor)
+            pivote = select(nombre, *por_mes, func.round(func.total(parcial.c.total), 2)) \
+                .select_from(parcial) \
+                .outerjoin(modelo, modelo.id == parcial.c.clave) \
+                .group_by(parcial.c.clave) \
+                .order_by(nombre)
+            columnas = [titulo.split(' x ')[0]] + [valor or 'Sin fecha' for valor in meses] + ['Total']
+            hojas.append((titulo, ReporteUseCase._lotes_consulta(db, pivote, columnas, tamano_lote), columnas))
+
+        mayores = ReporteUseCase._consulta_reporte(monto_base).order_by(monto_base.desc()).limit(top)
+        hojas.append((f'Top {top}', ReporteUseCase._lotes_consulta(db, mayores, COLUMNAS_REPORTE, tamano_lote),
+                      COLUMNAS_REPORTE))
+        return hojas
+
+    @staticmethod
+    def exportar_gastos(destino, formato: str = 'xlsx', tamano_lote: int = TAMANO_LOTE, resumenes: bool = False,
+                        top: int = TOP_GASTOS) -> ResultadoTransferencia:
+        """Exporta los gastos; con ``resumenes`` el libro Excel incluye además las hojas de análisis.
+
+        El resultado incluye la marca del registro de cambios leída en la misma transacción que los gastos, desde la
+        que ``exportar_cambios`` continúa sin perder ni repetir cambios.
+        """
+        handler = obtener_formato(formato)
+        if resumenes and not isinstance(handler, FormatoExcel):
+            raise ValueError("Las hojas de resumen solo están disponibles en formato xlsx.")
         db = SessionLocal()
         try:
-            return db.query(FraseMotivacional).all()
+            inicio = time.perf_counter()
+            filas = 0
+            # La primera lectura fija la instantánea: los gastos exportados son los vigentes en esta marca
+            marca = ReporteUseCase._marca_actual(db)
+
+            def contar(lotes):
+                nonlocal filas
+                for lote in lotes:
+                    filas += len(lote)
+                    yield lote
+
+            lotes = contar(ReporteUseCase._lotes_gastos(db, tamano_lote))
+            if resumenes:
+                handler.escribir_libro(destino, [('Gastos', lotes, COLUMNAS_REPORTE)] +
+                                       ReporteUseCase._hojas_resumen(db, tamano_lote, top))
+            else:
+                handler.escribir(destino, lotes, COLUMNAS_REPORTE)
+            return ResultadoTransferencia(filas, time.perf_counter() - inicio, marca=marca)
         finally:
             db.close()
 
+    @staticmethod
+    def generar_reporte(formato: str = 'xlsx', resumenes: bool = False) -> tuple:
+        output = io.BytesIO()
+        resultado = ReporteUseCase.exportar_gastos(output, formato, resumenes=resumenes)
+        return output.getvalue(), resultado
+
+    @staticmethod
+    def generar_reporte_excel() -> bytes:
+        return ReporteUseCase.generar_reporte('xlsx')[0]
+
+    @staticmethod
+    def _marca_actual(db) -> int:
+        # sqlite_sequence conserva la última secuencia asignada aunque se haya purgado el registro
+        return db.execute(text("SELECT seq FROM sqlite_sequence WHERE name = :tabla"),
+                          {'tabla': CambioGasto.__tablename__}).scalar() or 0
 
-class GastoUseCase:
     @staticmethod
-    def agregar_gasto(descripcion: str, monto: float, categoria_id: int, metodo_pago_id: int, fecha=None) -> None:
+    def _lotes_cambios(db, desde: int, tamano_lote: int) -> Iterator[pd.DataFrame]:
+        # Solo interesa el último cambio de cada gasto posterior a la marca
+        ultimos = select(func.max(CambioGasto.seq).label('seq')) \
+            .where(CambioGasto.seq > desde) \
+            .group_by(CambioGasto.gasto_id) \
+            .subquery()
+        eliminado = CambioGasto.operacion == 'D'
+        consulta = select(
+            CambioGasto.seq,
+            CambioGasto.operacion,
+            CambioGasto.gasto_id,
+            func.strftime(FORMATO_FECHA, Gasto.fecha),
+            Gasto.monto,
+            Gasto.moneda,
+            Gasto.descripcion,
+            Categoria.nombre,
+            MetodoPago.nombre,
+            func.round(monto_en_base(ReporteUseCase.moneda_base(db)), 2)
+        ).join(ultimos, CambioGasto.seq == ultimos.c.seq) \
+            .outerjoin(Gasto, (Gasto.id == CambioGasto.gasto_id) & ~eliminado) \
+            .outerjoin(Categoria, Gasto.categoria_id == Categoria.id) \
+            .outerjoin(MetodoPago, Gasto.metodo_pago_id == MetodoPago.id) \
+            .order_by(CambioGasto.seq)
+        resultado = db.execute(consulta, execution_options={'stream_results': True, 'yield_per': tamano_lote})
+        for filas in resultado.partitions():
+            yield pd.DataFrame(filas, columns=COLUMNAS_CAMBIOS)
+
+    @staticmethod
+    def exportar_cambios(destino, desde: int = 0, formato: str = 'csv', tamano_lote: int = TAMANO_LOTE) -> tuple:
+        """Exporta los gastos insertados, modificados o eliminados después de la marca ``desde``.
+
+        Devuelve el resultado de la transferencia y la nueva marca para la siguiente sincronización.
+        """
+        handler = obtener_formato(formato)
         db = SessionLocal()
         try:
-            gasto = Gasto(
-                descripcion=descripcion,
-                monto=monto,
-                categoria_id=categoria_id,
-                metodo_pago_id=metodo_pago_id,
-                fecha=fecha
-            )
-            db.add(gasto)
-            db.commit()
-            db.refresh(gasto)
+            inicio = time.perf_counter()
+            filas = 0
+            marca = desde
+
+            def seguir(lotes):
+                nonlocal filas, marca
+                for lote in lotes:
+                    filas += len(lote)
+                    marca = int(lote['Secuencia'].iloc[-1])
+                    yield lote
+
+            handler.escribir(destino, seguir(ReporteUseCase._lotes_cambios(db, desde, tamano_lote)), COLUMNAS_CAMBIOS)
+            return ResultadoTransferencia(filas, time.perf_counter() - inicio), marca
+        finally:
+            db.close()
+
+    @staticmethod
+    def purgar_cambios(hasta: int) -> int:
+        """Elimina del registro los cambios ya sincronizados hasta la marca ``hasta``."""
+        return escribir(ReporteUseCase._purgar_cambios, hasta)
+
+    @staticmethod
+    def _purgar_cambios(db, hasta: int) -> int:
+        eliminados = db.execute(delete(CambioGasto.__table__).where(CambioGasto.__table__.c.seq <= hasta)).rowcount
+        registrar_escritura(db)
+        return eliminados
+
+    @staticmethod
+    def _interpretar_fechas(valores: pd.Series) -> pd.Series:
+        """Fechas del archivo: el formato de exportación, luego ISO 8601 y por último día/mes/año."""
+        fechas = pd.to_datetime(valores, format=FORMATO_FECHA, errors='coerce')
+        for opciones in ({'format': 'ISO8601'}, {'format': 'mixed', 'dayfirst': True}):
+            pendientes = fechas.isna() & valores.notna()
+            if not pendientes.any():
+                break
+            fechas[pendientes] = pd.to_datetime(valores[pendientes], errors='coerce', **opciones)
+        return fechas
+
+    @staticmethod
+    def _preparar_lote(lote: pd.DataFrame, categorias: dict, metodos: dict, moneda_base: str) -> pd.DataFrame:
+        """Filas listas para insertar; ``fecha`` queda vacía solo si la celda estaba vacía.
+
+        Se descartan las filas sin descripción, monto, categoría o método de pago válidos y las de fecha ilegible.
+        """
+        faltantes = [columna for columna in COLUMNAS_IMPORTACION if columna not in lote.columns]
+        if faltantes:
+            raise ValueError(f"Faltan columnas en el archivo: {', '.join(faltantes)}")
+        valores = lote['Fecha'].mask(lote['Fecha'].astype(str).str.strip() == '')
+        fechas = ReporteUseCase._interpretar_fechas(valores)
+        monedas = lote['Moneda'].fillna(moneda_base).astype(str).str.upper() if 'Moneda' in lote.columns \
+            else moneda_base
+        registros = pd.DataFrame({
+            'descripcion': lote['Descripción'],
+            'monto': pd.to_numeric(lote['Monto'], errors='coerce'),
+            'categoria_id': lote['Categoría'].map(categorias),
+            'metodo_pago_id': lote['Método de Pago'].map(metodos),
+            'fecha': fechas,
+            'moneda': monedas,
+        })
+        registros = registros[fechas.notna() | valores.isna()]
+        return registros.dropna(subset=['descripcion', 'monto', 'categoria_id', 'metodo_pago_id'])
+
+    @staticmethod
+    def importar_gastos(archivo, formato: str = 'xlsx', tamano_lote: int = TAMANO_LOTE) -> ResultadoTransferencia:
+        """Importa gastos por lotes; las filas ya importadas antes (mismo hash de contenido) se omiten."""
+        return escribir(ReporteUseCase._importar_gastos, archivo, formato, tamano_lote)
+
+    @staticmethod
+    def _importar_gastos(db, archivo, formato: str, tamano_lote: int) -> ResultadoTransferencia:
+        handler = obtener_formato(formato)
+        sentencia = sqlite_insert(Gasto.__table__).on_conflict_do_nothing(index_elements=[Gasto.hash_contenido])
+        inicio = time.perf_counter()
+        categorias = dict(db.execute(select(Categoria.nombre, Categoria.id)).all())
+        metodos = dict(db.execute(select(MetodoPago.nombre, MetodoPago.id)).all())
+        moneda_base = ReporteUseCase.moneda_base(db)
+        ultimo_id = db.execute(select(func.coalesce(func.max(Gasto.id), 0))).scalar()
+        filas = omitidas = repetidas = sin_fecha = 0
+        for lote in handler.leer(archivo, tamano_lote):
+            registros = ReporteUseCase._preparar_lote(lote, categorias, metodos, moneda_base)
+            omitidas += len(lote) - len(registros)
+            if registros.empty:
+                continue
+            registros = registros.astype({'categoria_id': int, 'metodo_pago_id': int})
+            # El hash usa la fecha del archivo (vacía si faltaba) para que reimportarlo no duplique esas filas;
+            # solo después las celdas vacías reciben la fecha actual
+            fechas_archivo = [None if pd.isna(fecha) else fecha for fecha in registros['fecha']]
+            registros['hash_contenido'] = [
+                hash_gasto(*fila) for fila in zip(fechas_archivo, registros['monto'], registros['descripcion'],
+                                                  registros['categoria_id'], registros['metodo_pago_id'],
+                                                  registros['moneda'])
+            ]
+            sin_fecha += int(registros['fecha'].isna().sum())
+            registros['fecha'] = registros['fecha'].fillna(pd.Timestamp(datetime.utcnow()))
+            afectadas = db.execute(sentencia, registros.to_dict('records')).rowcount
+            filas += afectadas
+            repetidas += len(registros) - afectadas
+        # Las filas nuevas son las de id mayor al último existente antes de importar
+        EstadisticaUseCase.ajustar(db, Gasto.id > ultimo_id)
+        registrar_escritura(db)
+        return ResultadoTransferencia(filas, time.perf_counter() - inicio, omitidas, repetidas, sin_fecha)
+
+    @staticmethod
+    def importar_reporte_excel(file, formato: str = 'xlsx') -> None:
+        try:
+            resultado = ReporteUseCase.importar_gastos(file, formato)
         except Exception as e:
-            db.rollback()
+            st.error(f"Error al importar el reporte: {e}")
             raise e
+        if resultado.omitidas:
+            st.warning(f"Se omitieron {resultado.omitidas} filas con fecha ilegible o sin monto, categoría o método "
+                       f"de pago válidos.")
+        if resultado.sin_fecha:
+            st.info(f"{resultado.sin_fecha} filas no tenían fecha; las nuevas se registraron con la fecha de hoy.")
+        if resultado.duplicadas:
+            st.info(f"Se ignoraron {resultado.duplicadas} gastos que ya estaban registrados.")
+        st.success(f"Reporte importado correctamente: {resultado}.")
+
+    @staticmethod
+    def gastos_mensuales():
+        db = SessionLocal()
+        try:
+            resumen = db.query(
+                func.strftime('%Y-%m', Gasto.fecha).label('mes'),
+                func.sum(monto_en_base(ReporteUseCase.moneda_base(db))).label('monto_total')
+            ).group_by('mes').all()
+            return {mes: monto for mes, monto in resumen}
         finally:
             db.close()
 
     @staticmethod
-    def listar_gastos():
+    def dia_menor_gasto():
+        db = SessionLocal()
+        try:
+            resumen = db.query(
+                func.strftime('%Y-%m-%d', Gasto.fecha).label('dia'),
+                func.sum(monto_en_base(ReporteUseCase.moneda_base(db))).label('monto_total')
+            ).group_by('dia').order_by('monto_total').first()
+            return resumen.dia if resumen else None
+        finally:
+            db.close()
+
+    @staticmethod
+    def moneda_base(db=None) -> str:
+        sesion = db or SessionLocal()
+        try:
+            return sesion.execute(select(Configuracion.moneda_base).limit(1)).scalar() or MONEDA_PREDETERMINADA
+        finally:
+            if db is None:
+                sesion.close()
+
+    @staticmethod
+    def establecer_moneda_base(moneda: str) -> None:
+        """Cambia la moneda base; solo se aplican las tasas cargadas con esa misma moneda de cotización."""
+        escribir(ReporteUseCase._establecer_moneda_base, moneda.upper())
+
+    @staticmethod
+    def _establecer_moneda_base(db, moneda: str) -> None:
+        configuracion = db.query(Configuracion).first()
+        if configuracion and configuracion.moneda_base == moneda:
+            return
+        if configuracion:
+            configuracion.moneda_base = moneda
+        else:
+            configuracion = Configuracion(moneda_base=moneda)
+            db.add(configuracion)
+        db.flush()
+        EstadisticaUseCase.reconstruir(db)
+        registrar_escritura(db)
+
+    @staticmethod
+    def monedas_sin_tipo_cambio() -> list:
+        """Monedas usadas en gastos que no pueden convertirse a la moneda base."""
+        db = SessionLocal()
+        try:
+            base = ReporteUseCase.moneda_base(db)
+            con_tasa = select(TipoCambio.moneda).distinct().where(TipoCambio.moneda_base == base)
+            return list(db.execute(
+                select(Gasto.moneda).distinct().where(Gasto.moneda != base, Gasto.moneda.not_in(con_tasa))
+            ).scalars())
+        finally:
+            db.close()
+
+    @staticmethod
+    def limite_gasto() -> float:
+        db = SessionLocal()
+        try:
+            return db.execute(select(Configuracion.limite_gasto).limit(1)).scalar() or 0.0
+        finally:
+            db.close()
+
+    @staticmethod
+    def establecer_limite_gasto(limite: float) -> None:
+        escribir(ReporteUseCase._establecer_limite_gasto, limite)
+
+    @staticmethod
+    def _establecer_limite_gasto(db, limite: float) -> None:
+        configuracion = db.query(Configuracion).first()
+        if configuracion:
+            configuracion.limite_gasto = limite
+        else:
+            configuracion = Configuracion(limite_gasto=limite)
+            db.add(configuracion)
+        db.flush()
+        registrar_escritura(db)
+
+
+DIMENSIONES_ESTADISTICAS = {
+    'categoria': Gasto.categoria_id,
+    'metodo_pago': Gasto.metodo_pago_id,
+}
+UMBRAL_ANOMALIA = 3.0
+MINIMO_MUESTRAS_ANOMALIA = 10
+
+
+class EvaluacionGasto(NamedTuple):
+    monto_base: float
+    media: float
+    desviacion: float
+    puntaje_z: float
+
+    @property
+    def anomalo(self) -> bool:
+        return abs(self.puntaje_z) >= UMBRAL_ANOMALIA
+
+
+@trazar_metodos
+class EstadisticaUseCase:
+    """Mantiene media, varianza, mínimo y máximo por categoría y método de pago sin volver a recorrer los gastos.
+
+    Cada escritura agrega (o retira) el resumen de las filas afectadas calculado en SQL, y se combina con
+    el acumulado usando la fórmula de Chan para varianzas por partes. El mínimo y el máximo no pueden
+    retirarse, así que tras eliminar gastos son cotas; ``reconstruir`` los recalcula exactos.
+    """
+
+    @staticmethod
+    def _agregados(db, condicion, columna) -> list:
+        monto_base = monto_en_base(ReporteUseCase.moneda_base(db))
+        return db.execute(select(
+            columna,
+            func.count(monto_base),
+            func.sum(monto_base),
+            func.sum(monto_base * monto_base),
+            func.min(monto_base),
+            func.max(monto_base)
+        ).where(condicion).group_by(columna)).all()
+
+    @staticmethod
+    def _aplicar(db, dimension: str, clave_id: int, n: int, suma: float, cuadrados: float, minimo: float,
+                 maximo: float, signo: int = 1) -> None:
+        if clave_id is None or not n:
+            return
+        media_b = suma / n
+        m2_b = max(0.0, cuadrados - suma * suma / n)
+        fila = db.get(EstadisticaGasto, (dimension, clave_id))
+        if signo > 0:
+            if fila is None:
+                db.add(EstadisticaGasto(dimension=dimension, clave_id=clave_id, n=n, media=media_b, m2=m2_b,
+                                        minimo=minimo, maximo=maximo))
+                return
+            total = fila.n + n
+            delta = media_b - fila.media
+            fila.m2 = fila.m2 + m2_b + delta * delta * fila.n * n / total
+            fila.media = fila.media + delta * n / total
+            fila.n = total
+            fila.minimo = minimo if fila.minimo is None else min(fila.minimo, minimo)
+            fila.maximo = maximo if fila.maximo is None else max(fila.maximo, maximo)
+        elif fila is not None:
+            total = fila.n - n
+            if total <= 0:
+                db.delete(fila)
+                return
+            media = (fila.n * fila.media - n * media_b) / total
+            delta = media_b - media
+            fila.m2 = max(0.0, fila.m2 - m2_b - delta * delta * total * n / fila.n)
+            fila.media = media
+            fila.n = total
+
+    @staticmethod
+    def ajustar(db, condicion, signo: int = 1, dimensiones: dict = None) -> None:
+        """Suma (``signo=1``) o resta (``signo=-1``) de las estadísticas los gastos que cumplen ``condicion``."""
+        for dimension, columna in (dimensiones or DIMENSIONES_ESTADISTICAS).items():
+            for fila in EstadisticaUseCase._agregados(db, condicion, columna):
+                EstadisticaUseCase._aplicar(db, dimension, *fila, signo=signo)
+        db.flush()
+
+    @staticmethod
+    def trasladar(db, condicion, dimension: str, origen_id: int, destino_id: int) -> None:
+        """Mueve el resumen de los gastos que cumplen ``condicion`` de una clave a otra dentro de ``dimension``."""
+        columna = DIMENSIONES_ESTADISTICAS[dimension]
+        for _, *resumen in EstadisticaUseCase._agregados(db, condicion, columna):
+            EstadisticaUseCase._aplicar(db, dimension, origen_id, *resumen, signo=-1)
+            EstadisticaUseCase._aplicar(db, dimension, destino_id, *resumen, signo=1)
+        db.flush()
+
+    @staticmethod
+    def olvidar(db, dimension: str, clave_id: int) -> None:
+        db.execute(delete(EstadisticaGasto).where(EstadisticaGasto.dimension == dimension,
+                                                  EstadisticaGasto.clave_id == clave_id))
+
+    @staticmethod
+    def evaluar(db, id_gasto: int, categoria_id: int) -> EvaluacionGasto:
+        """Puntaje z del gasto frente a las estadísticas de su categoría, en O(1)."""
+        monto_base = db.execute(
+            select(monto_en_base(ReporteUseCase.moneda_base(db))).where(Gasto.id == id_gasto)
+        ).scalar()
+        fila = db.get(EstadisticaGasto, ('categoria', categoria_id)) if categoria_id else None
+        if monto_base is None or fila is None or fila.n < MINIMO_MUESTRAS_ANOMALIA or fila.desviacion == 0:
+            return None
+        return EvaluacionGasto(monto_base, fila.media, fila.desviacion, (monto_base - fila.media) / fila.desviacion)
+
+    @staticmethod
+    def reconstruir(db) -> int:
+        """Recalcula todas las estadísticas con un solo recorrido de los gastos."""
+        monto_base = monto_en_base(ReporteUseCase.moneda_base(db))
+        parciales = db.execute(select(
+            Gasto.categoria_id,
+            Gasto.metodo_pago_id,
+            func.count(monto_base),
+            func.sum(monto_base),
+            func.sum(monto_base * monto_base),
+            func.min(monto_base),
+            func.max(monto_base)
+        ).group_by(Gasto.categoria_id, Gasto.metodo_pago_id)).all()
+        db.execute(delete(EstadisticaGasto))
+        for categoria_id, metodo_pago_id, *resumen in parciales:
+            EstadisticaUseCase._aplicar(db, 'categoria', categoria_id, *resumen)
+            db.flush()
+            EstadisticaUseCase._aplicar(db, 'metodo_pago', metodo_pago_id, *resumen)
+            db.flush()
+        return len(parciales)
+
+    @staticmethod
+    def reconstruir_estadisticas() -> None:
+        escribir(EstadisticaUseCase._reconstruir_estadisticas)
+
+    @staticmethod
+    def _reconstruir_estadisticas(db) -> None:
+        EstadisticaUseCase.reconstruir(db)
+        registrar_escritura(db)
+
+    @staticmethod
+    def listar_estadisticas(dimension: str = 'categoria') -> pd.DataFrame:
+        modelo = Categoria if dimension == 'categoria' else MetodoPago
         db = SessionLocal()
         try:
-            return db.query(Gasto).options(
-                joinedload(Gasto.categoria),
-                joinedload(Gasto.metodo_pago)
+            filas = db.execute(
+                select(modelo.nombre, EstadisticaGasto)
+                .join(modelo, modelo.id == EstadisticaGasto.clave_id)
+                .where(EstadisticaGasto.dimension == dimension)
+                .order_by(modelo.nombre)
             ).all()
+            return pd.DataFrame([{
+                'Nombre': nombre,
+                'Gastos': estadistica.n,
+                'Media': round(estadistica.media, 2),
+                'Desviación': round(estadistica.desviacion, 2),
+                'Mínimo': estadistica.minimo,
+                'Máximo': estadistica.maximo,
+            } for nombre, estadistica in filas])
         finally:
             db.close()
 
     @staticmethod
-    def eliminar_gasto(id_gasto: int) -> None:
+    def listar_anomalias(limite: int = 50) -> list:
+        """Gastos más recientes cuyo monto se aleja más de ``UMBRAL_ANOMALIA`` desviaciones de su categoría."""
         db = SessionLocal()
         try:
-            gasto = db.query(Gasto).filter(Gasto.id == id_gasto).first()
-            if not gasto:
-                raise ValueError("Gasto no encontrado.")
-            db.delete(gasto)
-            db.commit()
-        except Exception as e:
-            db.rollback()
-            raise e
+            monto_base = monto_en_base(ReporteUseCase.moneda_base(db))
+            diferencia = monto_base - EstadisticaGasto.media
+            consulta = consulta_gasto_filas().join(
+                EstadisticaGasto,
+                (EstadisticaGasto.dimension == 'categoria') & (EstadisticaGasto.clave_id == Gasto.categoria_id)
+            ).where(
+                EstadisticaGasto.n >= MINIMO_MUESTRAS_ANOMALIA,
+                diferencia * diferencia > UMBRAL_ANOMALIA ** 2 * EstadisticaGasto.m2 / (EstadisticaGasto.n - 1)
+            ).order_by(Gasto.fecha.desc()).limit(limite)
+            return [GastoFila._make(fila) for fila in db.execute(consulta)]
+        finally:
+            db.close()
+
+
+FRECUENCIAS = ('mensual', 'semanal')
+
+
+def ocurrencias(frecuencia: str, dia: int, desde: date, hasta: date) -> Iterator[tuple]:
+    """Fechas de una regla recurrente entre ``desde`` y ``hasta`` (inclusive), con la clave de su periodo."""
+    if frecuencia == 'mensual':
+        anio, mes = desde.year, desde.month
+        while True:
+            fecha = date(anio, mes, min(dia, calendar.monthrange(anio, mes)[1]))
+            if fecha > hasta:
+                return
+            if fecha >= desde:
+                yield fecha, f"{anio:04d}-{mes:02d}"
+            anio, mes = (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+    elif frecuencia == 'semanal':
+        fecha = desde + timedelta(days=(dia - desde.weekday()) % 7)
+        while fecha <= hasta:
+            yield fecha, fecha.isoformat()
+            fecha += timedelta(days=7)
+    else:
+        raise ValueError(f"Frecuencia no válida: {frecuencia}")
+
+
+@trazar_metodos
+class RecurrenteUseCase:
+    @staticmethod
+    def agregar_recurrente(descripcion: str, monto: float, categoria_id: int, metodo_pago_id: int, frecuencia: str,
+                           dia: int, fecha_inicio: date, fecha_fin: date = None, moneda: str = None) -> None:
+        if frecuencia not in FRECUENCIAS:
+            raise ValueError(f"Frecuencia no válida: {frecuencia}")
+        if not (1 <= dia <= 31 if frecuencia == 'mensual' else 0 <= dia <= 6):
+            raise ValueError("Día no válido para la frecuencia seleccionada.")
+        escribir(RecurrenteUseCase._agregar_recurrente, descripcion, monto, categoria_id, metodo_pago_id, frecuencia,
+                 dia, fecha_inicio, fecha_fin, moneda)
+
+    @staticmethod
+    def _agregar_recurrente(db, descripcion: str, monto: float, categoria_id: int, metodo_pago_id: int,
+                            frecuencia: str, dia: int, fecha_inicio: date, fecha_fin: date, moneda: str) -> None:
+        db.add(GastoRecurrente(
+            descripcion=descripcion,
+            monto=monto,
+            moneda=(moneda or ReporteUseCase.moneda_base(db)).upper(),
+            categoria_id=categoria_id,
+            metodo_pago_id=metodo_pago_id,
+            frecuencia=frecuencia,
+            dia=dia,
+            fecha_inicio=fecha_inicio,
+            fecha_fin=fecha_fin
+        ))
+        db.flush()
+        registrar_escritura(db)
+
+    @staticmethod
+    def listar_recurrentes() -> pd.DataFrame:
+        db = SessionLocal()
+        try:
+            consulta = select(
+                GastoRecurrente.id.label('ID'),
+                GastoRecurrente.descripcion.label('Descripción'),
+                GastoRecurrente.monto.label('Monto'),
+                GastoRecurrente.moneda.label('Moneda'),
+                Categoria.nombre.label('Categoría'),
+                MetodoPago.nombre.label('Método de Pago'),
+                GastoRecurrente.frecuencia.label('Frecuencia'),
+                GastoRecurrente.dia.label('Día'),
+                GastoRecurrente.fecha_inicio.label('Desde'),
+                GastoRecurrente.fecha_fin.label('Hasta'),
+                GastoRecurrente.ultima_fecha.label('Último Generado'),
+                GastoRecurrente.activo.label('Activo')
+            ).outerjoin(Categoria, GastoRecurrente.categoria_id == Categoria.id) \
+                .outerjoin(MetodoPago, GastoRecurrente.metodo_pago_id == MetodoPago.id) \
+                .order_by(GastoRecurrente.id)
+            resultado = db.execute(consulta)
+            return pd.DataFrame(resultado.all(), columns=list(resultado.keys()))
         finally:
             db.close()
 
     @staticmethod
-    def actualizar_gasto(id_gasto: int, descripcion: str, monto: float, categoria_id: int, metodo_pago_id: int,
-                         fecha=None) -> None:
-        db = SessionLocal()
+    def cambiar_estado_recurrente(id_recurrente: int, activo: bool) -> None:
+        escribir(RecurrenteUseCase._cambiar_estado_recurrente, id_recurrente, activo)
+
+    @staticmethod
+    def _cambiar_estado_recurrente(db, id_recurrente: int, activo: bool) -> None:
+        recurrente = db.get(GastoRecurrente, id_recurrente)
+        if not recurrente:
+            raise ValueError("Gasto recurrente no encontrado.")
+        if activo and (recurrente.categoria_id is None or recurrente.metodo_pago_id is None):
+            raise ValueError("No se puede reanudar: su categoría o método de pago fue eliminado.")
+        recurrente.activo = activo
+        db.flush()
+        registrar_escritura(db)
+
+    @staticmethod
+    def eliminar_recurrente(id_recurrente: int) -> None:
+        """Elimina la regla; los gastos ya generados se conservan sin vínculo a ella."""
+        escribir(RecurrenteUseCase._eliminar_recurrente, id_recurrente)
+
+    @staticmethod
+    def _eliminar_recurrente(db, id_recurrente: int) -> None:
+        tabla = GastoRecurrente.__table__
+        if not db.execute(select(exists().where(tabla.c.id == id_recurrente))).scalar():
+            raise ValueError("Gasto recurrente no encontrado.")
+        db.execute(update(Gasto.__table__).where(Gasto.__table__.c.recurrente_id == id_recurrente)
+                   .values(recurrente_id=None))
+        db.execute(delete(tabla).where(tabla.c.id == id_recurrente))
+        registrar_escritura(db)
+
+    @staticmethod
+    def materializar_recurrentes(hasta: date = None) -> int:
+        """Genera en una sola transacción todos los gastos recurrentes pendientes hasta ``hasta`` (hoy).
+
+        Es idempotente: cada ocurrencia se identifica por (regla, periodo) y las ya existentes se ignoran.
+        Devuelve la cantidad de gastos insertados.
+        """
+        return escribir(RecurrenteUseCase._materializar_recurrentes, hasta or date.today())
+
+    @staticmethod
+    def _materializar_recurrentes(db, hasta: date) -> int:
+        reglas = db.execute(select(GastoRecurrente).where(
+            GastoRecurrente.activo.is_(True),
+            GastoRecurrente.fecha_inicio <= hasta
+        )).scalars().all()
+        registros, avances = [], []
+        ahora = datetime.utcnow()
+        for regla in reglas:
+            desde = regla.ultima_fecha + timedelta(days=1) if regla.ultima_fecha else regla.fecha_inicio
+            limite = min(hasta, regla.fecha_fin) if regla.fecha_fin else hasta
+            ultima = None
+            for fecha, periodo in ocurrencias(regla.frecuencia, regla.dia, desde, limite):
+                fecha_gasto = datetime.combine(fecha, datetime.min.time())
+                registros.append({
+                    'fecha': fecha_gasto,
+                    'monto': regla.monto,
+                    'moneda': regla.moneda,
+                    'descripcion': regla.descripcion,
+                    'categoria_id': regla.categoria_id,
+                    'metodo_pago_id': regla.metodo_pago_id,
+                    'recurrente_id': regla.id,
+                    'periodo': periodo,
+                    'created_at': ahora,
+                    'updated_at': ahora,
+                })
+                ultima = fecha
+            if ultima:
+                avances.append({'id_regla': regla.id, 'ultima': ultima})
+        insertados = 0
+        if registros:
+            ultimo_id = db.execute(select(func.coalesce(func.max(Gasto.id), 0))).scalar()
+            insertados = db.execute(sqlite_insert(Gasto.__table__).prefix_with('OR IGNORE'), registros).rowcount
+            EstadisticaUseCase.ajustar(db, Gasto.id > ultimo_id)
+            tabla = GastoRecurrente.__table__
+            db.execute(update(tabla).where(tabla.c.id == bindparam('id_regla'))
+                       .values(ultima_fecha=bindparam('ultima')), avances)
+            registrar_escritura(db)
+        return insertados
+
+
+@dataclass
+class ResultadoRespaldo:
+    ruta: str
+    bytes_copiados: int
+    tamano_archivo: int
+    segundos: float
+    # Veces que la copia por pasos volvió a empezar porque otra conexión escribió en el origen
+    reinicios: int = 0
+
+    @property
+    def mb_por_segundo(self) -> float:
+        megas = self.bytes_copiados / 2 ** 20
+        return megas / self.segundos if self.segundos > 0 else megas
+
+    def __str__(self):
+        return (f"{os.path.basename(self.ruta)}: {self.bytes_copiados / 2 ** 20:.1f} MB en {self.segundos:.2f} s "
+                f"({self.mb_por_segundo:.1f} MB/s), archivo de {self.tamano_archivo / 2 ** 20:.1f} MB"
+                + (f", {self.reinicios} reinicios" if self.reinicios else ""))
+
+
+REINICIOS_RESPALDO = 3
+
+
+class _CopiaReiniciada(Exception):
+    pass
+
+
+@trazar_metodos
+class RespaldoUseCase:
+    PREFIJO = 'gasto_magico-'
+
+    @staticmethod
+    def _copiar_en_linea(origen: sqlite3.Connection, destino: sqlite3.Connection, paginas_por_paso: int,
+                         pausa: float, max_reinicios: int = REINICIOS_RESPALDO) -> int:
+        """Copia por pasos y devuelve cuántas veces se reinició la copia.
+
+        Entre pasos se libera el bloqueo de lectura, así las sesiones activas pueden seguir escribiendo; pero cada
+        escritura de otra conexión hace que SQLite reinicie la copia desde el principio. Pasados ``max_reinicios``
+        se copia el resto en un solo paso, que mantiene una lectura hasta el final (en WAL no bloquea a los
+        escritores), para que el respaldo termine aunque la aplicación no deje de escribir.
+        """
+        reinicios = 0
+        anteriores = None
+
+        def progreso(estado, restantes, total):
+            nonlocal reinicios, anteriores
+            if anteriores is not None and restantes > anteriores:
+                reinicios += 1
+                if reinicios > max_reinicios:
+                    raise _CopiaReiniciada
+            anteriores = restantes
+            time.sleep(pausa)
+
+        try:
+            origen.backup(destino, pages=paginas_por_paso, progress=progreso)
+        except _CopiaReiniciada:
+            origen.backup(destino)
+        return reinicios
+
+    @staticmethod
+    def crear_respaldo(directorio: str = RESPALDOS_DIR, paginas_por_paso: int = 256, pausa: float = 0.005,
+                       comprimir: bool = True, conservar: int = 7) -> ResultadoRespaldo:
+        """Copia la base de datos en caliente con la API de respaldo de SQLite.
+
+        La copia avanza de ``paginas_por_paso`` páginas en ``paginas_por_paso`` páginas, pausando entre pasos.
+        Después se comprime opcionalmente y se conservan solo los ``conservar`` respaldos más recientes.
+        """
+        os.makedirs(directorio, exist_ok=True)
+        nombre = f"{RespaldoUseCase.PREFIJO}{datetime.now().strftime('%Y%m%d-%H%M%S-%f')[:-3]}.db"
+        temporal = os.path.join(directorio, f".{nombre}.tmp")
+        inicio = time.perf_counter()
+        origen = sqlite3.connect(DATABASE_PATH)
+        destino = sqlite3.connect(temporal)
+        try:
+            reinicios = RespaldoUseCase._copiar_en_linea(origen, destino, paginas_por_paso, pausa)
+            bytes_copiados = destino.execute("PRAGMA page_count").fetchone()[0] * \
+                destino.execute("PRAGMA page_size").fetchone()[0]
+        finally:
+            destino.close()
+            origen.close()
+
+        ruta = os.path.join(directorio, nombre)
+        if comprimir:
+            ruta += '.gz'
+            with open(temporal, 'rb') as entrada, gzip.open(ruta, 'wb', compresslevel=6) as salida:
+                shutil.copyfileobj(entrada, salida, 1024 * 1024)
+            os.remove(temporal)
+        else:
+            os.replace(temporal, ruta)
+        segundos = time.perf_counter() - inicio
+
+        for antiguo in RespaldoUseCase.listar_respaldos(directorio)[conservar:]:
+            os.remove(antiguo)
+        return ResultadoRespaldo(ruta, bytes_copiados, os.path.getsize(ruta), segundos, reinicios)
+
+    @staticmethod
+    def listar_respaldos(directorio: str = RESPALDOS_DIR) -> list:
+        """Rutas de los respaldos existentes, del más reciente al más antiguo."""
+        rutas = glob.glob(os.path.join(directorio, f"{RespaldoUseCase.PREFIJO}*.db")) + \
+            glob.glob(os.path.join(directorio, f"{RespaldoUseCase.PREFIJO}*.db.gz"))
+        return sorted(rutas, key=os.path.basename, reverse=True)
+
+    @staticmethod
+    def restaurar_respaldo(ruta: str, paginas_por_paso: int = 256, pausa: float = 0.0) -> ResultadoRespaldo:
+        """Verifica la integridad de un respaldo y lo copia sobre la base de datos en uso."""
+        inicio = time.perf_counter()
+        version_anterior = version_datos()
+        temporal = None
+        if ruta.endswith('.gz'):
+            temporal = f"{DATABASE_PATH}.restauracion.tmp"
+            with gzip.open(ruta, 'rb') as entrada, open(temporal, 'wb') as salida:
+                shutil.copyfileobj(entrada, salida, 1024 * 1024)
+        try:
+            origen = sqlite3.connect(temporal or ruta)
+            try:
+                try:
+                    integridad = origen.execute("PRAGMA integrity_check").fetchone()[0]
+                except sqlite3.DatabaseError as e:
+                    integridad = str(e)
+                if integridad != 'ok':
+                    raise ValueError(f"El respaldo está dañado: {integridad}")
+                destino = sqlite3.connect(DATABASE_PATH)
+                try:
+                    reinicios = RespaldoUseCase._copiar_en_linea(origen, destino, paginas_por_paso, pausa)
+                finally:
+                    destino.close()
+                bytes_copiados = origen.execute("PRAGMA page_count").fetchone()[0] * \
+                    origen.execute("PRAGMA page_size").fetchone()[0]
+            finally:
+                origen.close()
+        finally:
+            if temporal and os.path.exists(temporal):
+                os.remove(temporal)
+        # Las conexiones abiertas pueden tener el esquema anterior en caché
+        engine.dispose()
+        migrar_esquema()
+        # La versión restaurada puede ser menor que la vigente: se fuerza una nueva para invalidar las cachés
+        escribir(registrar_escritura, version_anterior)
+        return ResultadoRespaldo(ruta, bytes_copiados, os.path.getsize(DATABASE_PATH), time.perf_counter() - inicio,
+                                 reinicios)
+
+
+# Mantenimiento
+# Las importaciones y eliminaciones masivas dejan páginas libres y estadísticas del planificador desactualizadas.
+# El mantenimiento libera las páginas (auto_vacuum incremental), actualiza las estadísticas (ANALYZE /
+# PRAGMA optimize) y trunca el WAL; se ejecuta periódicamente desde la aplicación o con la línea de comandos
+INTERVALO_MANTENIMIENTO = timedelta(days=7)
+AUTO_VACUUM_INCREMENTAL = 2
+LIMITE_ANALISIS = 400
+
+
+@dataclass
+class EstadoBaseDatos:
+    tamano_archivo: int
+    tamano_wal: int
+    tamano_pagina: int
+    paginas: int
+    paginas_libres: int
+    auto_vacuum: int
+
+    @property
+    def proporcion_libre(self) -> float:
+        return self.paginas_libres / self.paginas if self.paginas else 0.0
+
+    def __str__(self):
+        return (f"{self.tamano_archivo / 2 ** 20:.1f} MB (+{self.tamano_wal / 2 ** 20:.1f} MB de WAL), "
+                f"{self.paginas_libres} de {self.paginas} páginas libres ({self.proporcion_libre:.1%})")
+
+
+@dataclass
+class ResultadoMantenimiento:
+    antes: EstadoBaseDatos
+    despues: EstadoBaseDatos
+    operaciones: list
+    segundos: float
+    tiempos: pd.DataFrame
+
+    def __str__(self):
+        return (f"{', '.join(self.operaciones)} en {self.segundos:.2f} s: "
+                f"{self.antes.tamano_archivo / 2 ** 20:.1f} MB -> {self.despues.tamano_archivo / 2 ** 20:.1f} MB, "
+                f"páginas libres {self.antes.proporcion_libre:.1%} -> {self.despues.proporcion_libre:.1%}")
+
+
+# Consultas representativas de la aplicación, cronometradas antes y después del mantenimiento. Se llaman las
+# funciones sin la envoltura de ``trazar_metodos`` para no sumar ejecuciones sintéticas a los histogramas.
+CONSULTAS_REFERENCIA = {
+    'Listado paginado': lambda: GastoUseCase.filtrar_gastos.__wrapped__(),
+    'Filtro por monto': lambda: GastoUseCase.filtrar_gastos.__wrapped__(monto_min=50.0, orden='monto'),
+    'Gastos mensuales': lambda: ReporteUseCase.gastos_mensuales.__wrapped__(),
+    'Día con menor gasto': lambda: ReporteUseCase.dia_menor_gasto.__wrapped__(),
+}
+
+
+@trazar_metodos
+class MantenimientoUseCase:
+    @staticmethod
+    def _conexion() -> sqlite3.Connection:
+        # VACUUM no puede ejecutarse dentro de una transacción: se usa una conexión en modo autocommit
+        conexion = sqlite3.connect(DATABASE_PATH, isolation_level=None)
+        conexion.execute(f"PRAGMA busy_timeout={ESPERA_BLOQUEO_MS}")
+        return conexion
+
+    @staticmethod
+    def _estado(conexion: sqlite3.Connection) -> EstadoBaseDatos:
+        def pragma(nombre):
+            return conexion.execute(f"PRAGMA {nombre}").fetchone()[0]
+
+        wal = f"{DATABASE_PATH}-wal"
+        return EstadoBaseDatos(
+            tamano_archivo=os.path.getsize(DATABASE_PATH),
+            tamano_wal=os.path.getsize(wal) if os.path.exists(wal) else 0,
+            tamano_pagina=pragma("page_size"),
+            paginas=pragma("page_count"),
+            paginas_libres=pragma("freelist_count"),
+            auto_vacuum=pragma("auto_vacuum"),
+        )
+
+    @staticmethod
+    def diagnostico() -> EstadoBaseDatos:
+        conexion = MantenimientoUseCase._conexion()
         try:
-            gasto = db.query(Gasto).filter(Gasto.id == id_gasto).first()
-            if not gasto:
-                raise ValueError("Gasto no encontrado.")
-            gasto.descripcion = descripcion
-            gasto.monto = monto
-            gasto.categoria_id = categoria_id
-            gasto.metodo_pago_id = metodo_pago_id
-            gasto.fecha = fecha
-            db.commit()
-        except Exception as e:
-            db.rollback()
-            raise e
+            return MantenimientoUseCase._estado(conexion)
         finally:
-            db.close()
+            conexion.close()
 
     @staticmethod
-    def filtrar_gastos(fecha_desde, fecha_hasta, categoria, metodo_pago):
-        db = SessionLocal()
+    def tamanos_objetos() -> pd.DataFrame:
+        """Tamaño de cada tabla e índice según ``dbstat``; sin esa extensión, solo se listan los objetos."""
+        conexion = MantenimientoUseCase._conexion()
         try:
-            query = db.query(Gasto).join(Categoria).join(MetodoPago)
-            if categoria != "Todas":
-                query = query.filter(Categoria.nombre == categoria)
-            if metodo_pago != "Todos":
-                query = query.filter(MetodoPago.nombre == metodo_pago)
-            if fecha_desde and fecha_hasta:
-                query = query.filter(Gasto.fecha >= fecha_desde, Gasto.fecha <= fecha_hasta)
-            return query.all()
+            try:
+                filas = conexion.execute("""
+                    SELECT s.name, m.type, m.tbl_name, COUNT(*), SUM(s.pgsize), SUM(s.unused)
+                    FROM dbstat AS s LEFT JOIN sqlite_master AS m ON m.name = s.name
+                    GROUP BY s.name ORDER BY SUM(s.pgsize) DESC
+                """).fetchall()
+            except sqlite3.OperationalError:  # SQLite compilado sin SQLITE_ENABLE_DBSTAT_VTAB
+                filas = conexion.execute("""
+                    SELECT name, type, tbl_name, NULL, NULL, NULL FROM sqlite_master
+                    WHERE type IN ('table', 'index') ORDER BY tbl_name, type DESC, name
+                """).fetchall()
         finally:
-            db.close()
+            conexion.close()
+        return pd.DataFrame(filas, columns=['Nombre', 'Tipo', 'Tabla', 'Páginas', 'Bytes', 'Bytes sin usar'])
 
+    @staticmethod
+    def cronometrar_consultas(repeticiones: int = 3) -> dict:
+        """Mejor tiempo, en milisegundos, de cada consulta de referencia."""
+        tiempos = {}
+        for nombre, consulta in CONSULTAS_REFERENCIA.items():
+            mejor = float('inf')
+            for _ in range(repeticiones):
+                inicio = time.perf_counter()
+                consulta()
+                mejor = min(mejor, time.perf_counter() - inicio)
+            tiempos[nombre] = round(mejor * 1000, 2)
+        return tiempos
 
-class ReporteUseCase:
     @staticmethod
-    def generar_reporte_excel() -> bytes:
-        db = SessionLocal()
+    def ejecutar_mantenimiento(completo: bool = False, repeticiones: int = 3) -> ResultadoMantenimiento:
+        """Libera páginas, actualiza las estadísticas del planificador y trunca el WAL.
+
+        Solo con ``completo`` se hace un VACUUM, que reescribe el archivo bloqueando las escrituras mientras dura;
+        es también lo que convierte una base existente a auto_vacuum incremental. Sin ``completo`` (como en las
+        ejecuciones programadas) solo se devuelven las páginas libres, si la base ya es incremental.
+        """
+        inicio = time.perf_counter()
+        tiempos_antes = MantenimientoUseCase.cronometrar_consultas(repeticiones)
+        operaciones = []
+        conexion = MantenimientoUseCase._conexion()
         try:
-            gastos = db.query(Gasto).all()
-            data = [{
-                'ID': gasto.id,
-                'Fecha': gasto.fecha.strftime("%Y-%m-%d %H:%M:%S") if gasto.fecha else "",
-                'Monto': gasto.monto,
-                'Descripción': gasto.descripcion,
-                'Categoría': gasto.categoria.nombre if gasto.categoria else "",
-                'Método de Pago': gasto.metodo_pago.nombre if gasto.metodo_pago else ""
-            } for gasto in gastos]
-            df = pd.DataFrame(data)
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Gastos')
-            processed_data = output.getvalue()
-            return processed_data
-        except Exception as e:
-            raise e
+            antes = MantenimientoUseCase._estado(conexion)
+            if completo:
+                conexion.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conexion.execute("VACUUM")
+                operaciones.append("VACUUM")
+            elif antes.auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+                operaciones.append("sin auto_vacuum incremental (requiere un mantenimiento completo)")
+            elif antes.paginas_libres:
+                # execute() solo avanza un paso (una página); executescript ejecuta la sentencia hasta el final
+                conexion.executescript("PRAGMA incremental_vacuum;")
+                operaciones.append(f"incremental_vacuum ({antes.paginas_libres} páginas)")
+            analizada = conexion.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is not None
+            if completo:
+                conexion.execute("ANALYZE")
+                operaciones.append("ANALYZE")
+            elif not analizada:
+                # Análisis aproximado: recorre unas pocas filas por índice y no retiene el bloqueo en bases grandes
+                conexion.execute(f"PRAGMA analysis_limit={LIMITE_ANALISIS}")
+                conexion.execute("ANALYZE")
+                operaciones.append(f"ANALYZE (límite {LIMITE_ANALISIS})")
+            else:
+                conexion.execute("PRAGMA optimize")
+                operaciones.append("PRAGMA optimize")
+            conexion.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            operaciones.append("wal_checkpoint")
+            despues = MantenimientoUseCase._estado(conexion)
         finally:
-            db.close()
+            conexion.close()
+        # Las conexiones del pool conservan planes preparados con las estadísticas anteriores
+        engine.dispose()
+        tiempos_despues = MantenimientoUseCase.cronometrar_consultas(repeticiones)
+        resultado = ResultadoMantenimiento(
+            antes, despues, operaciones, time.perf_counter() - inicio,
+            pd.DataFrame({
+                'Consulta': list(tiempos_antes),
+                'Antes (ms)': list(tiempos_antes.values()),
+                'Después (ms)': [tiempos_despues[nombre] for nombre in tiempos_antes],
+            })
+        )
+        escribir(MantenimientoUseCase._registrar_mantenimiento, resultado)
+        return resultado
 
     @staticmethod
-    def importar_reporte_excel(file) -> None:
-        db = SessionLocal()
-        try:
-            df = pd.read_excel(file)
-            for _, row in df.iterrows():
-                categoria = db.query(Categoria).filter(Categoria.nombre == row['Categoría']).first()
-                metodo_pago = db.query(MetodoPago).filter(MetodoPago.nombre == row['Método de Pago']).first()
-                if not categoria or not metodo_pago:
-                    st.warning(
-                        f"Categoría o método de pago no encontrados para la fila con descripción '{row['Descripción']}'.")
-                    continue
-                fecha = datetime.strptime(row['Fecha'], "%Y-%m-%d %H:%M:%S") if pd.notna(
-                    row['Fecha']) else datetime.utcnow()
-                gasto = Gasto(
-                    descripcion=row['Descripción'],
-                    monto=row['Monto'],
-                    categoria_id=categoria.id,
-                    metodo_pago_id=metodo_pago.id,
-                    fecha=fecha
-                )
-                db.add(gasto)
-            db.commit()
-            st.success("Reporte importado correctamente.")
-        except Exception as e:
-            db.rollback()
-            st.error(f"Error al importar el reporte: {e}")
-            raise e
-        finally:
-            db.close()
+    def _registrar_mantenimiento(db, resultado: ResultadoMantenimiento) -> None:
+        antes, despues = resultado.antes, resultado.despues
+        db.add(MantenimientoBaseDatos(
+            segundos=resultado.segundos,
+            bytes_antes=antes.tamano_archivo + antes.tamano_wal,
+            bytes_despues=despues.tamano_archivo + despues.tamano_wal,
+            proporcion_libre_antes=antes.proporcion_libre,
+            proporcion_libre_despues=despues.proporcion_libre,
+            operaciones=", ".join(resultado.operaciones),
+        ))
+        db.flush()
 
     @staticmethod
-    def gastos_mensuales():
+    def mantenimiento_pendiente(intervalo: timedelta = INTERVALO_MANTENIMIENTO) -> bool:
         db = SessionLocal()
         try:
-            resumen = db.query(
-                func.strftime('%Y-%m', Gasto.fecha).label('mes'),
-                func.sum(Gasto.monto).label('monto_total')
-            ).group_by('mes').all()
-            return {mes: monto for mes, monto in resumen}
+            ultimo = db.execute(select(func.max(MantenimientoBaseDatos.ejecutado_en))).scalar()
+            return ultimo is None or datetime.utcnow() - ultimo >= intervalo
         finally:
             db.close()
 
     @staticmethod
-    def dia_menor_gasto():
+    def listar_mantenimientos(limite: int = 20) -> pd.DataFrame:
         db = SessionLocal()
         try:
-            resumen = db.query(
-                func.strftime('%Y-%m-%d', Gasto.fecha).label('dia'),
-                func.sum(Gasto.monto).label('monto_total')
-            ).group_by('dia').order_by('monto_total').first()
-            return resumen.dia if resumen else None
+            filas = db.execute(
+                select(MantenimientoBaseDatos).order_by(MantenimientoBaseDatos.id.desc()).limit(limite)
+            ).scalars()
+            return pd.DataFrame([{
+                'Fecha': mantenimiento.ejecutado_en.strftime("%Y-%m-%d %H:%M"),
+                'Operaciones': mantenimiento.operaciones,
+                'Segundos': round(mantenimiento.segundos, 2),
+                'MB antes': round(mantenimiento.bytes_antes / 2 ** 20, 2),
+                'MB después': round(mantenimiento.bytes_despues / 2 ** 20, 2),
+                'Libres antes': f"{mantenimiento.proporcion_libre_antes:.1%}",
+                'Libres después': f"{mantenimiento.proporcion_libre_despues:.1%}",
+            } for mantenimiento in filas])
         finally:
             db.close()
 
-    @staticmethod
-    def establecer_limite_gasto(limite: float) -> None:
-        db = SessionLocal()
+
+@st.cache_resource(show_spinner=False)
+def candado_mantenimiento() -> threading.Lock:
+    return threading.Lock()
+
+
+def programar_mantenimiento() -> bool:
+    """Lanza el mantenimiento en segundo plano si corresponde y no hay otro en curso en el proceso."""
+    candado = candado_mantenimiento()
+    if not MantenimientoUseCase.mantenimiento_pendiente() or not candado.acquire(blocking=False):
+        return False
+
+    def ejecutar():
         try:
-            configuracion = db.query(Configuracion).first()
-            if configuracion:
-                configuracion.limite_gasto = limite
-            else:
-                configuracion = Configuracion(limite_gasto=limite)
-                db.add(configuracion)
-            db.commit()
+            MantenimientoUseCase.ejecutar_mantenimiento()
         except Exception as e:
-            db.rollback()
-            raise e
+            print(f"Error en el mantenimiento de la base de datos: {e}")
         finally:
-            db.close()
+            candado.release()
+
+    threading.Thread(target=ejecutar, name="mantenimiento-gastomagico", daemon=True).start()
+    return True
+
+
+# Caché de Lecturas
+# Cada rerun de Streamlit vuelve a ejecutar todas las lecturas; mientras la versión de los datos no cambie,
+# se responden desde la caché del proceso, compartida por todas las sesiones
+LECTURAS_CACHEADAS = {}
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _leer_con_cache(nombre: str, version: int, args: tuple, kwargs: dict):
+    return LECTURAS_CACHEADAS[nombre](*args, **kwargs)
+
+
+def lectura_cacheada(funcion):
+    """Cachea una lectura por nombre calificado, versión de los datos y argumentos."""
+    nombre = funcion.__qualname__
+    LECTURAS_CACHEADAS[nombre] = funcion
+
+    @functools.wraps(funcion)
+    def envoltura(*args, **kwargs):
+        return _leer_con_cache(nombre, version_vigente(), args, kwargs)
+    return envoltura
 
 
 # Controladores
@@ -454,55 +2478,75 @@ class TablaController:
         TablaUseCase.agregar_categoria(nombre)
 
     @staticmethod
+    @lectura_cacheada
     def listar_categorias():
         return TablaUseCase.listar_categorias()
 
     @staticmethod
-    def eliminar_categoria(id_categoria: int) -> None:
-        TablaUseCase.eliminar_categoria(id_categoria)
+    def eliminar_categoria(id_categoria: int, modo: str = 'bloquear', destino_id: int = None) -> int:
+        return TablaUseCase.eliminar_categoria(id_categoria, modo, destino_id)
 
     @staticmethod
     def agregar_metodo_pago(nombre: str) -> None:
         TablaUseCase.agregar_metodo_pago(nombre)
 
     @staticmethod
+    @lectura_cacheada
     def listar_metodos_pago():
         return TablaUseCase.listar_metodos_pago()
 
     @staticmethod
-    def eliminar_metodo_pago(id_metodo: int) -> None:
-        TablaUseCase.eliminar_metodo_pago(id_metodo)
+    def eliminar_metodo_pago(id_metodo: int, modo: str = 'bloquear', destino_id: int = None) -> int:
+        return TablaUseCase.eliminar_metodo_pago(id_metodo, modo, destino_id)
+
+    @staticmethod
+    def cargar_tipos_cambio(archivo, formato: str = 'csv') -> ResultadoTransferencia:
+        return TablaUseCase.cargar_tipos_cambio(archivo, formato)
+
+    @staticmethod
+    @lectura_cacheada
+    def listar_monedas() -> list:
+        return TablaUseCase.listar_monedas()
 
     @staticmethod
     def agregar_frase(texto: str) -> None:
         TablaUseCase.agregar_frase(texto)
 
     @staticmethod
+    @lectura_cacheada
     def listar_frases():
         return TablaUseCase.listar_frases()
 
 
 class GastoController:
     @staticmethod
-    def agregar_gasto(descripcion: str, monto: float, categoria_id: int, metodo_pago_id: int, fecha=None) -> None:
-        GastoUseCase.agregar_gasto(descripcion, monto, categoria_id, metodo_pago_id, fecha)
+    def agregar_gasto(descripcion: str, monto: float, categoria_id: int, metodo_pago_id: int, fecha=None,
+                      moneda: str = None):
+        return GastoUseCase.agregar_gasto(descripcion, monto, categoria_id, metodo_pago_id, fecha, moneda)
 
     @staticmethod
+    @lectura_cacheada
     def listar_gastos():
         return GastoUseCase.listar_gastos()
 
+    @staticmethod
+    @lectura_cacheada
+    def obtener_gasto(id_gasto: int):
+        return GastoUseCase.obtener_gasto(id_gasto)
+
     @staticmethod
     def eliminar_gasto(id_gasto: int) -> None:
         GastoUseCase.eliminar_gasto(id_gasto)
 
     @staticmethod
     def actualizar_gasto(id_gasto: int, descripcion: str, monto: float, categoria_id: int, metodo_pago_id: int,
-                         fecha=None) -> None:
-        GastoUseCase.actualizar_gasto(id_gasto, descripcion, monto, categoria_id, metodo_pago_id, fecha)
+                         fecha=None, moneda: str = None) -> None:
+        GastoUseCase.actualizar_gasto(id_gasto, descripcion, monto, categoria_id, metodo_pago_id, fecha, moneda)
 
     @staticmethod
-    def filtrar_gastos(fecha_desde, fecha_hasta, categoria, metodo_pago):
-        return GastoUseCase.filtrar_gastos(fecha_desde, fecha_hasta, categoria, metodo_pago)
+    @lectura_cacheada
+    def filtrar_gastos(**filtros) -> PaginaGastos:
+        return GastoUseCase.filtrar_gastos(**filtros)
 
 
 class ReporteController:
@@ -511,27 +2555,167 @@ class ReporteController:
         return ReporteUseCase.generar_reporte_excel()
 
     @staticmethod
-    def importar_reporte_excel(file) -> None:
-        ReporteUseCase.importar_reporte_excel(file)
+    def exportar_reporte(formato: str, resumenes: bool = False) -> tuple:
+        return ReporteUseCase.generar_reporte(formato, resumenes)
+
+    @staticmethod
+    def importar_reporte_excel(file, formato: str = 'xlsx') -> None:
+        ReporteUseCase.importar_reporte_excel(file, formato)
 
     @staticmethod
+    @lectura_cacheada
     def gastos_mensuales():
         return ReporteUseCase.gastos_mensuales()
 
     @staticmethod
+    @lectura_cacheada
     def dia_menor_gasto():
         return ReporteUseCase.dia_menor_gasto()
 
+    @staticmethod
+    @lectura_cacheada
+    def limite_gasto() -> float:
+        return ReporteUseCase.limite_gasto()
+
     @staticmethod
     def establecer_limite_gasto(limite: float) -> None:
         ReporteUseCase.establecer_limite_gasto(limite)
 
+    @staticmethod
+    @lectura_cacheada
+    def moneda_base() -> str:
+        return ReporteUseCase.moneda_base()
+
+    @staticmethod
+    def establecer_moneda_base(moneda: str) -> None:
+        ReporteUseCase.establecer_moneda_base(moneda)
+
+    @staticmethod
+    @lectura_cacheada
+    def monedas_sin_tipo_cambio() -> list:
+        return ReporteUseCase.monedas_sin_tipo_cambio()
+
+
+class RecurrenteController:
+    @staticmethod
+    def agregar_recurrente(**datos) -> None:
+        RecurrenteUseCase.agregar_recurrente(**datos)
+
+    @staticmethod
+    @lectura_cacheada
+    def listar_recurrentes() -> pd.DataFrame:
+        return RecurrenteUseCase.listar_recurrentes()
+
+    @staticmethod
+    def cambiar_estado_recurrente(id_recurrente: int, activo: bool) -> None:
+        RecurrenteUseCase.cambiar_estado_recurrente(id_recurrente, activo)
+
+    @staticmethod
+    def eliminar_recurrente(id_recurrente: int) -> None:
+        RecurrenteUseCase.eliminar_recurrente(id_recurrente)
+
+    @staticmethod
+    def materializar_recurrentes() -> int:
+        return RecurrenteUseCase.materializar_recurrentes()
+
+
+class EstadisticaController:
+    @staticmethod
+    @lectura_cacheada
+    def listar_estadisticas(dimension: str = 'categoria') -> pd.DataFrame:
+        return EstadisticaUseCase.listar_estadisticas(dimension)
+
+    @staticmethod
+    @lectura_cacheada
+    def listar_anomalias(limite: int = 50) -> list:
+        return EstadisticaUseCase.listar_anomalias(limite)
+
+    @staticmethod
+    def reconstruir_estadisticas() -> None:
+        EstadisticaUseCase.reconstruir_estadisticas()
+
+
+class RespaldoController:
+    @staticmethod
+    def crear_respaldo() -> ResultadoRespaldo:
+        return RespaldoUseCase.crear_respaldo()
+
+    @staticmethod
+    def listar_respaldos() -> list:
+        return RespaldoUseCase.listar_respaldos()
+
+
+class MantenimientoController:
+    @staticmethod
+    def diagnostico() -> EstadoBaseDatos:
+        return MantenimientoUseCase.diagnostico()
+
+    @staticmethod
+    def tamanos_objetos() -> pd.DataFrame:
+        return MantenimientoUseCase.tamanos_objetos()
+
+    @staticmethod
+    def ejecutar_mantenimiento(completo: bool = False) -> ResultadoMantenimiento:
+        return MantenimientoUseCase.ejecutar_mantenimiento(completo)
+
+    @staticmethod
+    def listar_mantenimientos() -> pd.DataFrame:
+        return MantenimientoUseCase.listar_mantenimientos()
+
+    @staticmethod
+    def programar_mantenimiento() -> bool:
+        return programar_mantenimiento()
+
+
+class MetricaController:
+    @staticmethod
+    def resumen() -> pd.DataFrame:
+        return obtener_metricas().resumen()
+
+    @staticmethod
+    def perfiles() -> list:
+        return list(obtener_metricas().perfiles)
+
+    @staticmethod
+    def exportar_prometheus() -> str:
+        return obtener_metricas().exportar_prometheus()
+
+    @staticmethod
+    def escribir_prometheus(ruta: str = METRICAS_PATH) -> str:
+        return obtener_metricas().escribir_prometheus(ruta)
+
+    @staticmethod
+    def reiniciar() -> None:
+        obtener_metricas().reiniciar()
+
 
 # Utilidades
 def mostrar_frase_motivacional(frase):
     return frase
 
 
+def tabla_gastos(gastos) -> pd.DataFrame:
+    df = pd.DataFrame(gastos, columns=GastoFila._fields)
+    return pd.DataFrame({
+        'ID': df['id'],
+        'Fecha': pd.to_datetime(df['fecha']).dt.strftime("%Y-%m-%d").fillna(""),
+        'Monto': df['monto'],
+        'Moneda': df['moneda'],
+        'Descripción': df['descripcion'],
+        'Categoría': df['categoria'].fillna("N/A"),
+        'Método de Pago': df['metodo_pago'].fillna("N/A"),
+    })
+
+
+DIAS_SEMANA = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
+
+ETIQUETAS_ELIMINACION = {
+    'bloquear': "Impedir si tiene gastos",
+    'cascada': "Eliminar sus gastos",
+    'reasignar': "Reasignar sus gastos",
+}
+
+
 # Inicializar la Base de Datos al inicio
 init_db()
 
@@ -650,23 +2834,47 @@ def get_random_frase():
 # Interfaz de Usuario
 def main():
     st.title("💰 GastoMágico - Control de Gastos Personal")
+    # Las lecturas cacheadas de este rerun comparten una sola consulta de la versión de los datos
+    olvidar_version()
+
+    # Generar los gastos recurrentes pendientes una vez por sesión
+    if 'recurrentes_materializados' not in st.session_state:
+        try:
+            generados = RecurrenteController.materializar_recurrentes()
+            if generados:
+                st.toast(f"Se registraron {generados} gastos recurrentes pendientes.")
+        except Exception as e:
+            st.error(f"Error al generar gastos recurrentes: {e}")
+        st.session_state['recurrentes_materializados'] = True
+        # El mantenimiento periódico corre en segundo plano para no demorar la interfaz
+        try:
+            MantenimientoController.programar_mantenimiento()
+        except Exception as e:
+            st.error(f"Error al programar el mantenimiento: {e}")
 
     # Frase Motivacional
     frase = get_random_frase()
     st.sidebar.markdown(f"## 💡 {frase}")
 
     # Navegación por pestañas
-    pestañas = ["💰 Gastos", "🏷️ Categorías", "💳 Métodos de Pago", "📈 Reportes"]
+    pestañas = ["💰 Gastos", "🔁 Recurrentes", "🏷️ Categorías", "💳 Métodos de Pago", "📈 Reportes"]
+    # La pestaña de administración solo aparece al abrir la aplicación con ?admin=1
+    if st.query_params.get("admin") == "1":
+        pestañas.append("🛠️ Administración")
     seleccion = st.sidebar.radio("Navegación", pestañas)
 
     if seleccion == "💰 Gastos":
         gastos_tab()
+    elif seleccion == "🔁 Recurrentes":
+        recurrentes_tab()
     elif seleccion == "🏷️ Categorías":
         categorias_tab()
     elif seleccion == "💳 Métodos de Pago":
         metodos_pago_tab()
     elif seleccion == "📈 Reportes":
         reportes_tab()
+    elif seleccion == "🛠️ Administración":
+        administracion_tab()
 
     # Banner Inferior
     display_banner()
@@ -684,7 +2892,8 @@ def gastos_tab():
             metodo_pago = st.selectbox("💳 Método de Pago",
                                        [met.nombre for met in TablaController.listar_metodos_pago()])
         with col2:
-            monto = st.number_input("💵 Monto ($)", min_value=0.0, step=0.01)
+            monto = st.number_input("💵 Monto", min_value=0.0, step=0.01)
+            moneda = st.selectbox("💱 Moneda", TablaController.listar_monedas())
             descripcion = st.text_input("📝 Descripción")
 
         submit_button = st.form_submit_button(label='➕ Agregar Gasto')
@@ -700,14 +2909,23 @@ def gastos_tab():
                 categoria_id = categorias_dict.get(categoria)
                 metodo_pago_id = metodos_dict.get(metodo_pago)
 
-                GastoController.agregar_gasto(
-                    descripcion=descripcion,
-                    monto=monto,
-                    categoria_id=categoria_id,
-                    metodo_pago_id=metodo_pago_id,
-                    fecha=fecha
-                )
-                st.success("Gasto agregado correctamente.")
+                try:
+                    evaluacion = GastoController.agregar_gasto(
+                        descripcion=descripcion,
+                        monto=monto,
+                        categoria_id=categoria_id,
+                        metodo_pago_id=metodo_pago_id,
+                        fecha=fecha,
+                        moneda=moneda
+                    )
+                    st.success("Gasto agregado correctamente.")
+                    if evaluacion and evaluacion.anomalo:
+                        st.warning(
+                            f"⚠️ Este gasto se aleja {abs(evaluacion.puntaje_z):.1f} desviaciones del promedio "
+                            f"de {categoria} ({evaluacion.media:.2f} ± {evaluacion.desviacion:.2f})."
+                        )
+                except Exception as e:
+                    st.error(f"Error al agregar gasto: {e}")
             else:
                 st.error("Por favor, complete todos los campos correctamente.")
 
@@ -715,38 +2933,95 @@ def gastos_tab():
 
     # Opciones para editar y eliminar
     st.subheader("Lista de Gastos")
-    gastos = GastoController.listar_gastos()
-    if gastos:
-        df_gastos = pd.DataFrame([{
-            'ID': gasto.id,
-            'Fecha': gasto.fecha.strftime("%Y-%m-%d") if gasto.fecha else "",
-            'Monto': gasto.monto,
-            'Descripción': gasto.descripcion,
-            'Categoría': gasto.categoria.nombre if gasto.categoria else "N/A",
-            'Método de Pago': gasto.metodo_pago.nombre if gasto.metodo_pago else "N/A"
-        } for gasto in gastos])
+    filtros = filtros_gastos()
+    resultado = GastoController.filtrar_gastos(**filtros)
+    if resultado.filas:
+        df_gastos = tabla_gastos(resultado.filas)
+
+        # La selección se hace sobre la página visible; no se cargan los IDs de toda la tabla
+        grilla = st.dataframe(df_gastos, use_container_width=True, key='grilla_gastos', on_select="rerun",
+                              selection_mode="single-row")
+        inicio = (resultado.pagina - 1) * resultado.tamano_pagina
+        st.caption(f"Mostrando {inicio + 1}–{inicio + len(resultado.filas)} de {resultado.total} gastos "
+                   f"(página {resultado.pagina} de {resultado.paginas}). Seleccione una fila para editarla.")
+        filas_seleccionadas = grilla.selection.rows
+        id_grilla = int(df_gastos['ID'].iloc[filas_seleccionadas[0]]) if filas_seleccionadas else None
+    elif resultado.total:
+        id_grilla = None
+        st.info("La página seleccionada no tiene gastos.")
+    else:
+        id_grilla = None
+        st.info("No hay gastos que coincidan con los filtros.")
+
+    # Botones para editar y eliminar
+    with st.expander("Acciones", expanded=id_grilla is not None):
+        id_buscado = st.number_input("Buscar gasto por ID (si no hay una fila seleccionada)", min_value=1, step=1,
+                                     value=None)
+        id_seleccionado = id_grilla if id_grilla is not None else id_buscado
+        if id_seleccionado is not None:
+            st.write(f"Gasto seleccionado: **#{int(id_seleccionado)}**")
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("✏️ Editar Gasto", disabled=id_seleccionado is None):
+                st.session_state['gasto_en_edicion'] = int(id_seleccionado)
+        with col2:
+            confirmar = st.checkbox("Confirmo que quiero eliminar el gasto seleccionado")
+            if st.button("🗑️ Eliminar Gasto", disabled=id_seleccionado is None or not confirmar):
+                eliminar_gasto(int(id_seleccionado))
 
-        st.dataframe(df_gastos, use_container_width=True)
+    # El formulario de edición se mantiene entre reruns hasta guardar o cancelar
+    if 'gasto_en_edicion' in st.session_state:
+        editar_gasto(st.session_state['gasto_en_edicion'])
 
-        # Botones para editar y eliminar
-        with st.expander("Acciones"):
-            id_seleccionado = st.selectbox("Seleccione el ID del gasto para editar/eliminar", df_gastos['ID'])
-            col1, col2 = st.columns(2)
-            with col1:
-                if st.button("✏️ Editar Gasto"):
-                    editar_gasto(id_seleccionado)
-            with col2:
-                if st.button("🗑️ Eliminar Gasto"):
-                    eliminar_gasto(id_seleccionado)
-    else:
-        st.info("No hay gastos registrados.")
+
+def filtros_gastos() -> dict:
+    def volver_a_primera_pagina():
+        # Con otros filtros o tamaño de página la página elegida puede quedar fuera de rango
+        st.session_state['pagina_gastos'] = 1
+
+    with st.expander("🔎 Filtros"):
+        categorias = {cat.nombre: cat.id for cat in TablaController.listar_categorias()}
+        metodos = {met.nombre: met.id for met in TablaController.listar_metodos_pago()}
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            fecha_desde = st.date_input("📅 Desde", value=None, on_change=volver_a_primera_pagina)
+            fecha_hasta = st.date_input("📅 Hasta", value=None, on_change=volver_a_primera_pagina)
+        with col2:
+            categorias_sel = st.multiselect("🏷️ Categorías", list(categorias), on_change=volver_a_primera_pagina)
+            metodos_sel = st.multiselect("💳 Métodos de Pago", list(metodos), on_change=volver_a_primera_pagina)
+        with col3:
+            monto_min = st.number_input("💵 Monto mínimo", min_value=0.0, step=0.01, value=None,
+                                        on_change=volver_a_primera_pagina)
+            monto_max = st.number_input("💵 Monto máximo", min_value=0.0, step=0.01, value=None,
+                                        on_change=volver_a_primera_pagina)
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            orden = st.selectbox("Ordenar por", list(ORDENES_GASTOS), on_change=volver_a_primera_pagina)
+        with col2:
+            descendente = st.checkbox("Descendente", value=True, on_change=volver_a_primera_pagina)
+        with col3:
+            tamano_pagina = st.selectbox("Filas por página", [25, 50, 100, 500], index=1,
+                                         on_change=volver_a_primera_pagina)
+        with col4:
+            pagina = st.number_input("Página", min_value=1, step=1, key='pagina_gastos')
+    return {
+        'fecha_desde': fecha_desde,
+        'fecha_hasta': fecha_hasta,
+        'categoria_ids': [categorias[nombre] for nombre in categorias_sel],
+        'metodo_pago_ids': [metodos[nombre] for nombre in metodos_sel],
+        'monto_min': monto_min,
+        'monto_max': monto_max,
+        'orden': orden,
+        'descendente': descendente,
+        'pagina': int(pagina),
+        'tamano_pagina': tamano_pagina,
+    }
 
 
 def editar_gasto(id_gasto):
-    gastos = GastoController.listar_gastos()
-    gasto = next((g for g in gastos if g.id == id_gasto), None)
+    gasto = GastoController.obtener_gasto(id_gasto)
     if gasto:
-        st.subheader("Editar Gasto")
+        st.subheader(f"Editar Gasto #{id_gasto}")
 
         with st.form(key='editar_gasto'):
             col1, col2 = st.columns(2)
@@ -755,7 +3030,7 @@ def editar_gasto(id_gasto):
                 categorias = TablaController.listar_categorias()
                 categorias_nombres = [cat.nombre for cat in categorias]
                 if gasto.categoria:
-                    index_categoria = categorias_nombres.index(gasto.categoria.nombre)
+                    index_categoria = categorias_nombres.index(gasto.categoria)
                 else:
                     index_categoria = 0
                 categoria = st.selectbox("🏷️ Categoría", categorias_nombres, index=index_categoria)
@@ -763,45 +3038,123 @@ def editar_gasto(id_gasto):
                 metodos = TablaController.listar_metodos_pago()
                 metodos_nombres = [met.nombre for met in metodos]
                 if gasto.metodo_pago:
-                    index_metodo = metodos_nombres.index(gasto.metodo_pago.nombre)
+                    index_metodo = metodos_nombres.index(gasto.metodo_pago)
                 else:
                     index_metodo = 0
                 metodo_pago = st.selectbox("💳 Método de Pago", metodos_nombres, index=index_metodo)
             with col2:
-                monto = st.number_input("💵 Monto ($)", min_value=0.0, step=0.01, value=gasto.monto)
+                monto = st.number_input("💵 Monto", min_value=0.0, step=0.01, value=gasto.monto)
+                monedas = TablaController.listar_monedas()
+                if gasto.moneda not in monedas:
+                    monedas.append(gasto.moneda)
+                moneda = st.selectbox("💱 Moneda", monedas, index=monedas.index(gasto.moneda))
                 descripcion = st.text_input("📝 Descripción", value=gasto.descripcion)
 
             submit_button = st.form_submit_button(label='✅ Guardar Cambios')
+            cancelar = st.form_submit_button(label='✖️ Cancelar')
 
+            if cancelar:
+                del st.session_state['gasto_en_edicion']
+                st.rerun()
             if submit_button:
                 if descripcion and monto > 0:
                     # Obtener IDs de categoría y método de pago
                     categoria_id = next(cat.id for cat in categorias if cat.nombre == categoria)
                     metodo_pago_id = next(met.id for met in metodos if met.nombre == metodo_pago)
 
-                    GastoController.actualizar_gasto(
-                        id_gasto=id_gasto,
-                        descripcion=descripcion,
-                        monto=monto,
-                        categoria_id=categoria_id,
-                        metodo_pago_id=metodo_pago_id,
-                        fecha=fecha
-                    )
-                    st.success("Gasto actualizado correctamente.")
+                    try:
+                        GastoController.actualizar_gasto(
+                            id_gasto=id_gasto,
+                            descripcion=descripcion,
+                            monto=monto,
+                            categoria_id=categoria_id,
+                            metodo_pago_id=metodo_pago_id,
+                            fecha=fecha,
+                            moneda=moneda
+                        )
+                        del st.session_state['gasto_en_edicion']
+                        st.success("Gasto actualizado correctamente.")
+                    except Exception as e:
+                        st.error(f"Error al actualizar gasto: {e}")
                 else:
                     st.error("Por favor, complete todos los campos correctamente.")
     else:
+        del st.session_state['gasto_en_edicion']
         st.error("Gasto no encontrado.")
 
 
 def eliminar_gasto(id_gasto):
-    confirm = st.checkbox("¿Está seguro de eliminar este gasto?")
-    if confirm:
-        try:
-            GastoController.eliminar_gasto(id_gasto)
-            st.success("Gasto eliminado correctamente.")
-        except Exception as e:
-            st.error(f"Error al eliminar el gasto: {e}")
+    try:
+        GastoController.eliminar_gasto(id_gasto)
+        st.session_state.pop('gasto_en_edicion', None)
+        st.success("Gasto eliminado correctamente.")
+    except Exception as e:
+        st.error(f"Error al eliminar el gasto: {e}")
+
+
+def recurrentes_tab():
+    st.header("🔁 Gastos Recurrentes")
+
+    # Formulario para agregar una regla recurrente
+    with st.form(key='agregar_recurrente'):
+        categorias = {cat.nombre: cat.id for cat in TablaController.listar_categorias()}
+        metodos = {met.nombre: met.id for met in TablaController.listar_metodos_pago()}
+        col1, col2 = st.columns(2)
+        with col1:
+            descripcion = st.text_input("📝 Descripción")
+            monto = st.number_input("💵 Monto", min_value=0.0, step=0.01)
+            moneda = st.selectbox("💱 Moneda", TablaController.listar_monedas())
+            categoria = st.selectbox("🏷️ Categoría", list(categorias))
+            metodo_pago = st.selectbox("💳 Método de Pago", list(metodos))
+        with col2:
+            frecuencia = st.selectbox("🔁 Frecuencia", FRECUENCIAS)
+            dia_mes = st.number_input("Día del mes (mensual)", min_value=1, max_value=31, value=1)
+            dia_semana = st.selectbox("Día de la semana (semanal)", range(7), format_func=DIAS_SEMANA.__getitem__)
+            fecha_inicio = st.date_input("📅 Desde", value=date.today())
+            fecha_fin = st.date_input("📅 Hasta (opcional)", value=None)
+
+        if st.form_submit_button(label='➕ Agregar Recurrente'):
+            if descripcion and monto > 0:
+                try:
+                    RecurrenteController.agregar_recurrente(
+                        descripcion=descripcion,
+                        monto=monto,
+                        categoria_id=categorias.get(categoria),
+                        metodo_pago_id=metodos.get(metodo_pago),
+                        frecuencia=frecuencia,
+                        dia=int(dia_mes) if frecuencia == 'mensual' else dia_semana,
+                        fecha_inicio=fecha_inicio,
+                        fecha_fin=fecha_fin,
+                        moneda=moneda
+                    )
+                    generados = RecurrenteController.materializar_recurrentes()
+                    st.success(f"Gasto recurrente agregado; se registraron {generados} gastos pendientes.")
+                except Exception as e:
+                    st.error(f"Error al agregar gasto recurrente: {e}")
+            else:
+                st.error("Por favor, complete todos los campos correctamente.")
+
+    st.markdown("---")
+
+    st.subheader("Lista de Recurrentes")
+    df_recurrentes = RecurrenteController.listar_recurrentes()
+    if not df_recurrentes.empty:
+        st.dataframe(df_recurrentes, use_container_width=True)
+
+        with st.form(key='acciones_recurrente'):
+            id_seleccionado = st.selectbox("Seleccione el ID del gasto recurrente", df_recurrentes['ID'])
+            accion = st.radio("Acción", ["Pausar", "Reanudar", "Eliminar"], horizontal=True)
+            if st.form_submit_button(label="✅ Aplicar"):
+                try:
+                    if accion == "Eliminar":
+                        RecurrenteController.eliminar_recurrente(id_seleccionado)
+                    else:
+                        RecurrenteController.cambiar_estado_recurrente(id_seleccionado, accion == "Reanudar")
+                    st.success("Gasto recurrente actualizado correctamente.")
+                except Exception as e:
+                    st.error(f"Error al actualizar el gasto recurrente: {e}")
+    else:
+        st.info("No hay gastos recurrentes registrados.")
 
 
 def categorias_tab():
@@ -834,16 +3187,26 @@ def categorias_tab():
         } for cat in categorias])
         st.dataframe(df_categorias, use_container_width=True)
 
-        # Botón para eliminar categoría
-        id_seleccionado = st.selectbox("Seleccione el ID de la categoría para eliminar", df_categorias['ID'])
-        if st.button("🗑️ Eliminar Categoría"):
-            confirm = st.checkbox("¿Está seguro de eliminar esta categoría? (Se eliminarán todos los gastos asociados)")
-            if confirm:
-                try:
-                    TablaController.eliminar_categoria(id_seleccionado)
-                    st.success("Categoría eliminada correctamente.")
-                except Exception as e:
-                    st.error(f"Error al eliminar categoría: {e}")
+        # Formulario para eliminar categoría
+        with st.form(key='eliminar_categoria'):
+            id_seleccionado = st.selectbox("Seleccione el ID de la categoría para eliminar", df_categorias['ID'])
+            modo = st.radio("¿Qué hacer con sus gastos?", MODOS_ELIMINACION, format_func=ETIQUETAS_ELIMINACION.get,
+                            horizontal=True)
+            destino_id = st.selectbox("Categoría destino (solo al reasignar)", df_categorias['ID'],
+                                      format_func=dict(zip(df_categorias['ID'], df_categorias['Nombre'])).get)
+            confirm = st.checkbox("¿Está seguro de eliminar esta categoría?")
+            if st.form_submit_button(label="🗑️ Eliminar Categoría"):
+                if confirm:
+                    try:
+                        repetidos = TablaController.eliminar_categoria(id_seleccionado, modo, destino_id)
+                        st.success("Categoría eliminada correctamente.")
+                        if repetidos:
+                            st.warning(f"Se eliminaron {repetidos} gastos importados que quedaban idénticos a otros "
+                                       f"de la categoría destino.")
+                    except Exception as e:
+                        st.error(f"Error al eliminar categoría: {e}")
+                else:
+                    st.error("Confirme la eliminación para continuar.")
     else:
         st.info("No hay categorías registradas.")
 
@@ -878,45 +3241,62 @@ def metodos_pago_tab():
         } for met in metodos])
         st.dataframe(df_metodos, use_container_width=True)
 
-        # Botón para eliminar método de pago
-        id_seleccionado = st.selectbox("Seleccione el ID del método de pago para eliminar", df_metodos['ID'])
-        if st.button("🗑️ Eliminar Método de Pago"):
-            confirm = st.checkbox(
-                "¿Está seguro de eliminar este método de pago? (Se eliminarán todos los gastos asociados)")
-            if confirm:
-                try:
-                    TablaController.eliminar_metodo_pago(id_seleccionado)
-                    st.success("Método de pago eliminado correctamente.")
-                except Exception as e:
-                    st.error(f"Error al eliminar método de pago: {e}")
+        # Formulario para eliminar método de pago
+        with st.form(key='eliminar_metodo_pago'):
+            id_seleccionado = st.selectbox("Seleccione el ID del método de pago para eliminar", df_metodos['ID'])
+            modo = st.radio("¿Qué hacer con sus gastos?", MODOS_ELIMINACION, format_func=ETIQUETAS_ELIMINACION.get,
+                            horizontal=True)
+            destino_id = st.selectbox("Método destino (solo al reasignar)", df_metodos['ID'],
+                                      format_func=dict(zip(df_metodos['ID'], df_metodos['Nombre'])).get)
+            confirm = st.checkbox("¿Está seguro de eliminar este método de pago?")
+            if st.form_submit_button(label="🗑️ Eliminar Método de Pago"):
+                if confirm:
+                    try:
+                        repetidos = TablaController.eliminar_metodo_pago(id_seleccionado, modo, destino_id)
+                        st.success("Método de pago eliminado correctamente.")
+                        if repetidos:
+                            st.warning(f"Se eliminaron {repetidos} gastos importados que quedaban idénticos a otros "
+                                       f"del método de pago destino.")
+                    except Exception as e:
+                        st.error(f"Error al eliminar método de pago: {e}")
+                else:
+                    st.error("Confirme la eliminación para continuar.")
     else:
         st.info("No hay métodos de pago registrados.")
 
 
 def reportes_tab():
     st.header("📈 Reportes y Configuración")
+    moneda_base = ReporteController.moneda_base()
+    sin_tipo_cambio = ReporteController.monedas_sin_tipo_cambio()
+    if sin_tipo_cambio:
+        st.warning(f"Los gastos en {', '.join(sin_tipo_cambio)} no tienen tipo de cambio a {moneda_base} "
+                   f"y no se incluyen en los totales.")
 
     # Opciones de Reportes
     st.subheader("Generar Reportes")
 
+    formato = st.selectbox("📄 Formato", list(FORMATOS))
     col1, col2 = st.columns(2)
     with col1:
-        if st.button("💾 Exportar a Excel"):
-            reporte = ReporteController.exportar_reporte_excel()
+        resumenes = formato == 'xlsx' and st.checkbox(
+            "Incluir hojas de resumen (mensual, categoría x mes, método x mes y mayores gastos)")
+        if st.button("💾 Exportar"):
+            reporte, resultado = ReporteController.exportar_reporte(formato, resumenes)
+            st.caption(f"Exportadas {resultado}")
             st.download_button(
-                label="✅ Descargar Reporte Excel",
+                label="✅ Descargar Reporte",
                 data=reporte,
-                file_name='reporte_gastos.xlsx',
-                mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+                file_name=f'reporte_gastos.{formato}',
+                mime=FORMATOS[formato].mime
             )
     with col2:
-        if st.button("📥 Importar desde Excel"):
-            file = st.file_uploader("Selecciona el archivo Excel", type=["xlsx"])
-            if file:
-                try:
-                    ReporteController.importar_reporte_excel(file)
-                except Exception as e:
-                    st.error(f"Error al importar reporte: {e}")
+        file = st.file_uploader("Selecciona el archivo a importar", type=[formato])
+        if file and st.button("📥 Importar"):
+            try:
+                ReporteController.importar_reporte_excel(file, formato)
+            except Exception as e:
+                st.error(f"Error al importar reporte: {e}")
 
     st.markdown("---")
 
@@ -935,7 +3315,7 @@ def reportes_tab():
                 ax.bar(meses, montos, color='#27ae60')
                 ax.set_title("Gastos Mensuales")
                 ax.set_xlabel("Mes")
-                ax.set_ylabel("Monto ($)")
+                ax.set_ylabel(f"Monto ({moneda_base})")
                 plt.xticks(rotation=45)
                 st.pyplot(fig)
             else:
@@ -945,21 +3325,24 @@ def reportes_tab():
         if st.button("📊 Día con Menor Gasto"):
             dia_menor = ReporteController.dia_menor_gasto()
             if dia_menor:
-                gastos = GastoUseCase.filtrar_gastos(
+                gastos = GastoController.filtrar_gastos(
                     fecha_desde=datetime.strptime(dia_menor, "%Y-%m-%d").date(),
                     fecha_hasta=datetime.strptime(dia_menor, "%Y-%m-%d").date(),
-                    categoria="Todas",
-                    metodo_pago="Todos"
-                )
+                    orden='fecha',
+                    descendente=False,
+                    tamano_pagina=None
+                ).filas
                 if gastos:
-                    dias = [gasto.fecha.strftime("%Y-%m-%d") for gasto in gastos]
-                    montos = [gasto.monto for gasto in gastos]
+                    # Sin tipo de cambio a la moneda base el gasto no se puede graficar en esa moneda
+                    convertidos = [gasto for gasto in gastos if gasto.monto_base is not None]
+                    dias = [gasto.fecha.strftime("%Y-%m-%d") for gasto in convertidos]
+                    montos = [gasto.monto_base for gasto in convertidos]
 
                     fig, ax = plt.subplots()
                     ax.bar(dias, montos, color='#e74c3c')
                     ax.set_title("Gasto por Día")
                     ax.set_xlabel("Día")
-                    ax.set_ylabel("Monto ($)")
+                    ax.set_ylabel(f"Monto ({moneda_base})")
                     plt.xticks(rotation=45)
                     st.pyplot(fig)
                 else:
@@ -969,28 +3352,83 @@ def reportes_tab():
 
     st.markdown("---")
 
+    # Estadísticas
+    st.subheader("Estadísticas y Gastos Inusuales")
+
+    dimension = st.radio("Agrupar por", ['categoria', 'metodo_pago'], horizontal=True,
+                         format_func=lambda valor: "Categoría" if valor == 'categoria' else "Método de Pago")
+    estadisticas = EstadisticaController.listar_estadisticas(dimension)
+    if not estadisticas.empty:
+        st.dataframe(estadisticas, use_container_width=True)
+    else:
+        st.info("No hay estadísticas disponibles.")
+
+    anomalias = EstadisticaController.listar_anomalias()
+    if anomalias:
+        st.caption(f"Gastos a más de {UMBRAL_ANOMALIA:g} desviaciones del promedio de su categoría")
+        st.dataframe(tabla_gastos(anomalias), use_container_width=True)
+
+    if st.button("🔄 Reconstruir Estadísticas"):
+        try:
+            EstadisticaController.reconstruir_estadisticas()
+            st.success("Estadísticas reconstruidas.")
+        except Exception as e:
+            st.error(f"Error al reconstruir estadísticas: {e}")
+
+    st.markdown("---")
+
     # Configuración
     st.subheader("Configuración")
 
-    configuracion = None
-    db = SessionLocal()
-    try:
-        configuracion = db.query(Configuracion).first()
-    finally:
-        db.close()
-
     with st.form(key='configuracion'):
-        limite_gasto = st.number_input("📉 Establecer Límite de Gasto ($)", min_value=0.0, step=0.01,
-                                       value=configuracion.limite_gasto if configuracion else 0.0)
+        limite_gasto = st.number_input(f"📉 Establecer Límite de Gasto ({moneda_base})", min_value=0.0, step=0.01,
+                                       value=ReporteController.limite_gasto())
+        nueva_moneda_base = st.text_input("💱 Moneda base (código ISO de 3 letras)", value=moneda_base, max_chars=3)
         submit_button = st.form_submit_button(label='✅ Establecer')
 
         if submit_button:
             try:
                 ReporteController.establecer_limite_gasto(limite_gasto)
-                st.success(f"Límite de gasto establecido en ${limite_gasto:.2f}")
+                if len(nueva_moneda_base.strip()) != 3:
+                    raise ValueError("La moneda base debe ser un código de 3 letras.")
+                # Cambiar la moneda base recalcula todas las estadísticas: solo se hace si cambió
+                if nueva_moneda_base.strip().upper() != moneda_base:
+                    ReporteController.establecer_moneda_base(nueva_moneda_base.strip())
+                st.success(f"Límite de gasto establecido en {limite_gasto:.2f} {nueva_moneda_base.upper()}")
             except Exception as e:
                 st.error(f"Error al establecer límite de gasto: {e}")
 
+    archivo_tasas = st.file_uploader(
+        f"💱 Tipos de cambio (columnas Moneda, Fecha, Tasa; la tasa es el valor de una unidad en {moneda_base})",
+        type=list(FORMATOS)
+    )
+    if archivo_tasas and st.button("📥 Cargar Tipos de Cambio"):
+        try:
+            resultado = TablaController.cargar_tipos_cambio(archivo_tasas,
+                                                            os.path.splitext(archivo_tasas.name)[1])
+            st.success(f"Tipos de cambio cargados: {resultado}")
+        except Exception as e:
+            st.error(f"Error al cargar tipos de cambio: {e}")
+
+    st.markdown("---")
+
+    # Respaldos
+    st.subheader("Respaldos")
+
+    if st.button("🛟 Crear Respaldo"):
+        try:
+            resultado = RespaldoController.crear_respaldo()
+            st.success(f"Respaldo creado: {resultado}")
+        except Exception as e:
+            st.error(f"Error al crear el respaldo: {e}")
+    respaldos = RespaldoController.listar_respaldos()
+    if respaldos:
+        st.dataframe(pd.DataFrame({
+            'Respaldo': [os.path.basename(ruta) for ruta in respaldos],
+            'Tamaño (MB)': [round(os.path.getsize(ruta) / 2 ** 20, 2) for ruta in respaldos],
+        }), use_container_width=True)
+        st.caption("Para restaurar un respaldo ejecute: python main.py restaurar <archivo>")
+
     st.markdown("---")
 
     # Gráficos Automáticos
@@ -1007,7 +3445,7 @@ def reportes_tab():
             ax.bar(meses, montos, color='#27ae60')
             ax.set_title("Gastos Mensuales")
             ax.set_xlabel("Mes")
-            ax.set_ylabel("Monto ($)")
+            ax.set_ylabel(f"Monto ({moneda_base})")
             plt.xticks(rotation=45)
             st.pyplot(fig)
         else:
@@ -1016,21 +3454,24 @@ def reportes_tab():
     with col2:
         dia_menor = ReporteController.dia_menor_gasto()
         if dia_menor:
-            gastos = GastoUseCase.filtrar_gastos(
+            gastos = GastoController.filtrar_gastos(
                 fecha_desde=datetime.strptime(dia_menor, "%Y-%m-%d").date(),
                 fecha_hasta=datetime.strptime(dia_menor, "%Y-%m-%d").date(),
-                categoria="Todas",
-                metodo_pago="Todos"
-            )
+                orden='fecha',
+                descendente=False,
+                tamano_pagina=None
+            ).filas
             if gastos:
-                dias = [gasto.fecha.strftime("%Y-%m-%d") for gasto in gastos]
-                montos = [gasto.monto for gasto in gastos]
+                # Sin tipo de cambio a la moneda base el gasto no se puede graficar en esa moneda
+                convertidos = [gasto for gasto in gastos if gasto.monto_base is not None]
+                dias = [gasto.fecha.strftime("%Y-%m-%d") for gasto in convertidos]
+                montos = [gasto.monto_base for gasto in convertidos]
 
                 fig, ax = plt.subplots()
                 ax.bar(dias, montos, color='#e74c3c')
                 ax.set_title("Gasto por Día")
                 ax.set_xlabel("Día")
-                ax.set_ylabel("Monto ($)")
+                ax.set_ylabel(f"Monto ({moneda_base})")
                 plt.xticks(rotation=45)
                 st.pyplot(fig)
             else:
@@ -1039,6 +3480,270 @@ def reportes_tab():
             st.info("No hay suficientes datos para mostrar.")
 
 
+def administracion_tab():
+    st.header("🛠️ Administración")
+
+    st.subheader("Latencia por Operación")
+    resumen = MetricaController.resumen()
+    if not resumen.empty:
+        st.dataframe(resumen, use_container_width=True)
+    else:
+        st.info("Todavía no se registraron operaciones en este proceso.")
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.download_button(
+            label="📥 Descargar métricas (Prometheus)",
+            data=MetricaController.exportar_prometheus(),
+            file_name="metricas.prom",
+            mime="text/plain"
+        )
+    with col2:
+        if st.button("💾 Guardar métricas"):
+            st.success(f"Métricas escritas en {MetricaController.escribir_prometheus()}")
+    with col3:
+        if st.button("🧹 Reiniciar métricas"):
+            MetricaController.reiniciar()
+            st.success("Métricas reiniciadas.")
+
+    st.subheader("Base de Datos")
+    estado = MantenimientoController.diagnostico()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Tamaño del archivo", f"{estado.tamano_archivo / 2 ** 20:.1f} MB")
+    col2.metric("WAL", f"{estado.tamano_wal / 2 ** 20:.1f} MB")
+    col3.metric("Páginas libres", f"{estado.proporcion_libre:.1%}")
+    with st.expander("Tamaño de tablas e índices"):
+        st.dataframe(MantenimientoController.tamanos_objetos(), use_container_width=True)
+
+    if estado.auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+        st.info("La base de datos no usa auto_vacuum incremental: el mantenimiento habitual no puede liberar sus "
+                "páginas libres hasta que se ejecute un mantenimiento completo, que la convierte.")
+    completo = st.checkbox("Mantenimiento completo (VACUUM y ANALYZE; bloquea las escrituras mientras dura)")
+    if st.button("🧰 Ejecutar Mantenimiento"):
+        try:
+            resultado = MantenimientoController.ejecutar_mantenimiento(completo)
+            st.success(f"Mantenimiento terminado: {resultado}")
+            st.dataframe(resultado.tiempos, use_container_width=True)
+        except Exception as e:
+            st.error(f"Error al ejecutar el mantenimiento: {e}")
+
+    historial = MantenimientoController.listar_mantenimientos()
+    if not historial.empty:
+        st.caption(f"Últimas ejecuciones (se repite automáticamente cada {INTERVALO_MANTENIMIENTO.days} días)")
+        st.dataframe(historial, use_container_width=True)
+
+    st.subheader("Perfiles de Llamadas Lentas")
+    st.caption(f"Se perfila el {MUESTREO_PERFIL:.0%} de las llamadas y se conservan las que superan "
+               f"{UMBRAL_PERFIL_SEGUNDOS} s.")
+    perfiles = MetricaController.perfiles()
+    if perfiles:
+        for perfil in perfiles:
+            with st.expander(f"{perfil.operacion} — {perfil.segundos:.2f} s — "
+                             f"{perfil.registrado_en.strftime('%Y-%m-%d %H:%M:%S')}"):
+                st.code(perfil.estadisticas)
+    else:
+        st.info("No hay perfiles registrados.")
+
+
+# Benchmarks
+def _medir(funcion, repeticiones: int) -> tuple:
+    """Devuelve el mejor tiempo en segundos y el pico de memoria en bytes de ``funcion``."""
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        mejor = min(mejor, time.perf_counter() - inicio)
+    tracemalloc.start()
+    try:
+        funcion()
+        pico = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return mejor, pico
+
+
+def benchmark_lecturas(repeticiones: int = 3) -> pd.DataFrame:
+    """Compara la carga del listado de gastos mediante objetos ORM y mediante modelos de lectura."""
+    def con_orm():
+        db = SessionLocal()
+        try:
+            gastos = db.query(Gasto).options(joinedload(Gasto.categoria), joinedload(Gasto.metodo_pago)).all()
+        finally:
+            db.close()
+        return pd.DataFrame([{
+            'ID': gasto.id,
+            'Fecha': gasto.fecha.strftime("%Y-%m-%d") if gasto.fecha else "",
+            'Monto': gasto.monto,
+            'Descripción': gasto.descripcion,
+            'Categoría': gasto.categoria.nombre if gasto.categoria else "N/A",
+            'Método de Pago': gasto.metodo_pago.nombre if gasto.metodo_pago else "N/A"
+        } for gasto in gastos])
+
+    def con_filas():
+        return tabla_gastos(GastoUseCase.listar_gastos())
+
+    resultados = []
+    for nombre, funcion in (("ORM", con_orm), ("Modelos de lectura", con_filas)):
+        segundos, pico = _medir(funcion, repeticiones)
+        resultados.append({'Ruta': nombre, 'Segundos': round(segundos, 4), 'Memoria pico (MB)': round(pico / 2 ** 20, 2)})
+    return pd.DataFrame(resultados)
+
+
+def prueba_estres_escrituras(sesiones: int = 16, escrituras: int = 50) -> pd.DataFrame:
+    """Simula ``sesiones`` usuarios que registran gastos a la vez, con y sin la cola de escritura.
+
+    Cada modo usa una base temporal nueva; la base de la aplicación no se modifica.
+    """
+    global engine, SessionLocal, ESCRITURA_SERIALIZADA
+    originales = engine, SessionLocal, ESCRITURA_SERIALIZADA
+    directorio = tempfile.mkdtemp(prefix="gastomagico-estres-")
+    resultados = []
+    try:
+        for nombre, serializada in (("Sesión por escritura", False), ("Cola serializada", True)):
+            engine = crear_motor(f"sqlite:///{os.path.join(directorio, f'estres-{len(resultados)}.db')}")
+            SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+            ESCRITURA_SERIALIZADA = serializada
+            migrar_esquema()
+            TablaUseCase.agregar_categoria("Estrés")
+            TablaUseCase.agregar_metodo_pago("Estrés")
+            categoria_id = TablaUseCase.listar_categorias()[0].id
+            metodo_pago_id = TablaUseCase.listar_metodos_pago()[0].id
+
+            def sesion(numero):
+                latencias, errores = [], 0
+                for i in range(escrituras):
+                    inicio = time.perf_counter()
+                    try:
+                        GastoUseCase.agregar_gasto(f"Sesión {numero} gasto {i}", 1.0 + i, categoria_id,
+                                                   metodo_pago_id)
+                    except Exception:
+                        errores += 1
+                    latencias.append(time.perf_counter() - inicio)
+                return latencias, errores
+
+            inicio = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=sesiones) as ejecutor:
+                partes = list(ejecutor.map(sesion, range(sesiones)))
+            segundos = time.perf_counter() - inicio
+            latencias = pd.Series([latencia for parte in partes for latencia in parte[0]]) * 1000
+            resultados.append({
+                'Modo': nombre,
+                'Escrituras': len(latencias),
+                'Errores': sum(parte[1] for parte in partes),
+                'Escrituras/s': round(len(latencias) / segundos, 1),
+                'p50 (ms)': round(latencias.quantile(0.5), 2),
+                'p99 (ms)': round(latencias.quantile(0.99), 2),
+            })
+            engine.dispose()
+    finally:
+        engine, SessionLocal, ESCRITURA_SERIALIZADA = originales
+        shutil.rmtree(directorio, ignore_errors=True)
+    return pd.DataFrame(resultados)
+
+
+# Línea de Comandos
+def cli(argumentos):
+    parser = argparse.ArgumentParser(prog="main.py", description="Herramientas de GastoMágico")
+    parser.add_argument("--metricas", metavar="ARCHIVO",
+                        help="Al terminar, escribe las métricas de latencia en formato Prometheus")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    exportar = comandos.add_parser("exportar", help="Exporta los gastos a xlsx, csv o parquet")
+    exportar.add_argument("archivo")
+    exportar.add_argument("--lote", type=int, default=TAMANO_LOTE)
+    exportar.add_argument("--resumenes", action="store_true",
+                          help="Agrega hojas de resumen mensual, por categoría, por método y mayores gastos (xlsx)")
+    exportar.add_argument("--top", type=int, default=TOP_GASTOS, help="Cantidad de gastos en la hoja de mayores")
+
+    importar = comandos.add_parser("importar", help="Importa gastos desde xlsx, csv o parquet")
+    importar.add_argument("archivo")
+    importar.add_argument("--lote", type=int, default=TAMANO_LOTE)
+
+    cambios = comandos.add_parser("cambios", help="Exporta los cambios posteriores a una marca de sincronización")
+    cambios.add_argument("archivo")
+    cambios.add_argument("--desde", type=int, default=0)
+    cambios.add_argument("--lote", type=int, default=TAMANO_LOTE)
+    cambios.add_argument("--purgar", action="store_true", help="Elimina del registro los cambios exportados")
+
+    respaldar = comandos.add_parser("respaldar", help="Crea un respaldo en caliente de la base de datos")
+    respaldar.add_argument("--directorio", default=RESPALDOS_DIR)
+    respaldar.add_argument("--paginas-por-paso", type=int, default=256)
+    respaldar.add_argument("--pausa", type=float, default=0.005, help="Segundos de espera entre pasos")
+    respaldar.add_argument("--sin-comprimir", action="store_true")
+    respaldar.add_argument("--conservar", type=int, default=7)
+
+    restaurar = comandos.add_parser("restaurar", help="Verifica un respaldo y lo restaura")
+    restaurar.add_argument("archivo")
+
+    recurrentes = comandos.add_parser("recurrentes", help="Genera los gastos recurrentes pendientes")
+    recurrentes.add_argument("--hasta", type=date.fromisoformat, default=None, help="Fecha límite (AAAA-MM-DD)")
+
+    comandos.add_parser("estadisticas", help="Recalcula las estadísticas por categoría y método de pago")
+
+    benchmark = comandos.add_parser("benchmark", help="Compara el listado de gastos con ORM y con modelos de lectura")
+    benchmark.add_argument("--repeticiones", type=int, default=3)
+
+    mantenimiento = comandos.add_parser("mantenimiento",
+                                        help="Libera páginas, actualiza estadísticas y trunca el WAL")
+    mantenimiento.add_argument("--completo", action="store_true", help="Fuerza VACUUM y ANALYZE completos")
+    mantenimiento.add_argument("--si-corresponde", action="store_true",
+                               help="Solo ejecuta si pasó el intervalo desde el último mantenimiento (para cron)")
+    mantenimiento.add_argument("--repeticiones", type=int, default=3)
+
+    estres = comandos.add_parser("estres", help="Mide la latencia de escritura con varias sesiones concurrentes")
+    estres.add_argument("--sesiones", type=int, default=16)
+    estres.add_argument("--escrituras", type=int, default=50, help="Gastos registrados por cada sesión")
+
+    args = parser.parse_args(argumentos)
+    formato = os.path.splitext(getattr(args, "archivo", ""))[1]
+
+    if args.comando == "exportar":
+        resultado = ReporteUseCase.exportar_gastos(args.archivo, formato, args.lote, args.resumenes, args.top)
+        print(f"Exportadas {resultado}; marca de cambios: {resultado.marca}")
+    elif args.comando == "importar":
+        resultado = ReporteUseCase.importar_gastos(args.archivo, formato, args.lote)
+        print(f"Importadas {resultado}; omitidas {resultado.omitidas}; duplicadas {resultado.duplicadas}; "
+              f"sin fecha {resultado.sin_fecha}")
+    elif args.comando == "cambios":
+        resultado, marca = ReporteUseCase.exportar_cambios(args.archivo, args.desde, formato, args.lote)
+        print(f"Exportados {resultado}; nueva marca: {marca}")
+        if args.purgar:
+            print(f"Cambios purgados: {ReporteUseCase.purgar_cambios(marca)}")
+    elif args.comando == "respaldar":
+        resultado = RespaldoUseCase.crear_respaldo(args.directorio, args.paginas_por_paso, args.pausa,
+                                                   not args.sin_comprimir, args.conservar)
+        print(f"Respaldo creado: {resultado}")
+    elif args.comando == "restaurar":
+        print(f"Respaldo restaurado: {RespaldoUseCase.restaurar_respaldo(args.archivo)}")
+    elif args.comando == "recurrentes":
+        inicio = time.perf_counter()
+        generados = RecurrenteUseCase.materializar_recurrentes(args.hasta)
+        print(f"Gastos recurrentes generados: {generados} en {time.perf_counter() - inicio:.2f} s")
+    elif args.comando == "estadisticas":
+        inicio = time.perf_counter()
+        EstadisticaUseCase.reconstruir_estadisticas()
+        print(f"Estadísticas reconstruidas en {time.perf_counter() - inicio:.2f} s")
+    elif args.comando == "benchmark":
+        print(benchmark_lecturas(args.repeticiones).to_string(index=False))
+    elif args.comando == "mantenimiento":
+        if args.si_corresponde and not MantenimientoUseCase.mantenimiento_pendiente():
+            print("El mantenimiento no corresponde todavía.")
+        else:
+            print(f"Antes: {MantenimientoUseCase.diagnostico()}")
+            resultado = MantenimientoUseCase.ejecutar_mantenimiento(args.completo, args.repeticiones)
+            print(f"Mantenimiento: {resultado}")
+            print(resultado.tiempos.to_string(index=False))
+            print(MantenimientoUseCase.tamanos_objetos().head(10).to_string(index=False))
+    elif args.comando == "estres":
+        print(prueba_estres_escrituras(args.sesiones, args.escrituras).to_string(index=False))
+
+    if args.metricas:
+        print(f"Métricas escritas en {obtener_metricas().escribir_prometheus(args.metricas)}")
+
+
 # Ejecutar la Aplicación
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        cli(sys.argv[1:])
+    else:
+        main()